@@ -1,67 +1,205 @@
-from flask import Blueprint, jsonify, request
+import time
+from flask import Blueprint, Response, g, jsonify, request
 from sysutils import logger, version
 import db
+import metrics
+import seed
+import tracing
+from jobs import job_manager
 api = Blueprint("api", __name__)
 
+REQUEST_LATENCY = metrics.Histogram(
+    "abasyn_http_request_seconds", "Time spent serving API requests",
+    ("endpoint", "method"),
+)
+REQUESTS = metrics.Counter(
+    "abasyn_http_requests_total", "API requests served",
+    ("endpoint", "method", "status"),
+)
+
+
+@api.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@api.after_request
+def record_timing(response):
+    started = g.get("request_started")
+    if started is not None:
+        endpoint = request.endpoint or "unknown"
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - started, endpoint, request.method
+        )
+        REQUESTS.inc(endpoint, request.method, response.status_code)
+    return response
+
+
+@api.errorhandler(db.UnknownSource)
+def unknown_source(e):
+    return jsonify({"status": str(e)}), 404
+
+
+def source_arg():
+    # the master database a request is about, ?source=<name>, the first
+    # configured one by default
+    source = request.args.get("source")
+    if source is None and request.is_json:
+        source = (request.get_json(silent=True) or {}).get("source")
+    return db.source_name(source)
+
+
+def start_job(kind, func, *args):
+    # slow database work runs as a job, ?wait=<seconds> waits for it
+    job = job_manager().submit(kind, func, *args)
+    if job is None:
+        return jsonify({"status": "busy", "message": "Job queue is full"}), 503
+    wait = request.args.get("wait", type=float)
+    if wait:
+        job.done.wait(min(wait, 60))
+    if job.done.is_set():
+        return jsonify(job.status())
+    response = jsonify(job.status())
+    response.status_code = 202
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return response
+
+
+@api.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(
+        metrics.render(), mimetype="text/plain; version=0.0.4"
+    )
+
 
 @api.route("/api/status/", methods=["GET"])
 def status():
     logger.info("Getting app status")
-    listener = db.listener_thread()
-    res = listener.status() if listener else {"status": "stopped"}
+    res = db.replication_status(request.args.get("source"))
     res['version'] = version
+    res['jobs'] = job_manager().stats()
+    res['check_cache'] = db.history_cache().stats()
     return jsonify(res)
 
 
+@api.route("/api/jobs/<id>", methods=["GET"])
+def job_status(id):
+    job = job_manager().get(id)
+    if job is None:
+        return jsonify({"status": "not found"}), 404
+    return jsonify(job.status())
+
+
 @api.route("/api/repl/check/<id>/", methods=["GET"])
 def check(id):
     logger.info("Checking a commodity history differences")
-    result = db.check_tovar_history(id)
-    return jsonify(result)
+    return start_job(
+        "check", db.check_tovar_history, id, request.args.get("receiver"),
+        source_arg(),
+    )
 
 
-@api.route("/api/repl/check_all/", methods=["GET"])
+@api.route("/api/repl/check_all/", methods=["GET", "POST"])
 def check_all():
-    logger.info("Checking all commodities history differences")
-    result = {"status": "to be implemented"}
+    if request.method == "POST":
+        logger.info("Checking all commodities history differences")
+        receiver_id = (request.get_json(silent=True) or {}).get("receiver")
+        return start_job(
+            "check_all", db.start_consistency_scan, receiver_id, source_arg()
+        )
+    else:
+        logger.info("Getting commodities history check progress")
+        result = db.consistency_scan_status(source_arg())
     return jsonify(result)
 
 
 @api.route("/api/repl/status/", methods=["GET"])
 def sync_status():
     logger.info("Checking replication status")
-    result = db.check_replication_status()
+    result = db.check_replication_status(source_arg())
     return jsonify(result)
 
 
 @api.route("/api/repl/initialize/", methods=["POST"])
 def sync_initialize():
     logger.info("Initializing replication")
-    result = db.init_replication()
-    return jsonify(result)
+    return start_job("initialize", db.init_replication, source_arg())
 
 
 @api.route("/api/repl/receiver/", methods=["POST"])
 @api.route("/api/repl/receiver/<id>/", methods=["GET", "DELETE"])
 def receiver(id=None):
+    source = source_arg()
     if request.method == "GET":
         logger.info("Getting receiver info")
-        result = db.get_receiver(id)
+        result = db.get_receiver(id, source)
     elif request.method == "POST":
         logger.info("Creating receiver")
         alias = request.get_json()["alias"]
         dbname = request.get_json()["dbname"]
         dbuser = request.get_json().get("dbuser", "SYSDBA")
         dbpass = request.get_json().get("dbpass", "masterkey")
-        result = db.add_receiver(alias, dbname, dbuser, dbpass)
+        result = db.add_receiver(alias, dbname, dbuser, dbpass, source)
+        if result.get("id") is not None and request.get_json().get("seed"):
+            result["seed"] = seed.start_seed(result["id"], source)
     elif request.method == "DELETE":
         logger.info("Deleting receiver")
-        result = db.del_receiver(id)
+        result = db.del_receiver(id, source)
+    return jsonify(result)
+
+
+@api.route(
+    "/api/repl/receiver/<id>/seed/", methods=["GET", "POST", "DELETE"]
+)
+def receiver_seed(id):
+    if request.method == "POST":
+        logger.info("Seeding receiver")
+        result = seed.start_seed(id, source_arg())
+    elif request.method == "DELETE":
+        logger.info("Cancelling receiver seed")
+        result = seed.cancel_seed(id, source_arg())
+    else:
+        logger.info("Getting receiver seed progress")
+        result = seed.seed_status(id, source_arg())
     return jsonify(result)
 
 
 @api.route("/api/repl/receivers/", methods=["GET"])
 def receivers():
     logger.info("Listing receivers")
-    result = db.get_receivers()
+    result = db.get_receivers(source_arg())
+    return jsonify(result)
+
+
+@api.route("/api/sources/", methods=["GET"])
+def sources():
+    logger.info("Listing sources")
+    return jsonify({"status": "ok", "sources": list(db.sources())})
+
+
+@api.route("/api/debug/trace", methods=["GET", "POST"])
+def debug_trace():
+    if request.method == "POST":
+        options = request.get_json(silent=True) or {}
+        if options.get("reset"):
+            tracing.reset()
+        if "enabled" in options:
+            logger.info("Switching tracing")
+            tracing.enable(options["enabled"])
+    return jsonify(tracing.status())
+
+
+@api.route("/api/debug/profile", methods=["GET", "POST", "DELETE"])
+def debug_profile():
+    if request.method == "POST":
+        logger.info("Starting the profiler")
+        options = request.get_json(silent=True) or {}
+        result = tracing.start_profiler(
+            options.get("seconds"), options.get("interval")
+        )
+    elif request.method == "DELETE":
+        logger.info("Stopping the profiler")
+        result = tracing.stop_profiler()
+    else:
+        result = tracing.profiler_status()
     return jsonify(result)
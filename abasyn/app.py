@@ -1,18 +1,20 @@
 import signal
 import platform
 import sys
-from flask import Flask
-from waitress import serve
-from api import api
-from sysutils import logger, config
-from db import (
-    listener_thread,
-    stop_event_processing,
-)
+import time
+from sysutils import logger, config, setup_logging
 
-app = Flask(__name__)
-app.register_blueprint(api)
-app.json.ensure_ascii = False
+listeners = []
+
+
+def create_app():
+    from flask import Flask
+    from api import api
+
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    app.json.ensure_ascii = False
+    return app
 
 
 def signal_handler(sig, frame):
@@ -20,14 +22,55 @@ def signal_handler(sig, frame):
     shutdown()
 
 
-def shutdown():
+def reload_handler(sig, frame):
+    from db import reload_settings
+
+    logger.info("Reloading configuration")
     try:
-        stop_event_processing()
-        logger.info("Stopping the service gracefully")
+        config.reload()
+        setup_logging()
+        reload_settings()
+    except Exception as e:
+        logger.error("Reloading configuration failed: %s", e)
+
+
+def join_listeners():
+    from db import drain_remaining
+
+    # workers get the drain time, listeners a little more to hand over
+    deadline = time.monotonic() + drain_remaining() + 10
+    for listener in listeners:
         if listener.is_alive():
-            logger.info("Joining the listener thread")
-            listener.join()
-            logger.info("Listener thread joined")
+            logger.info("Joining the listener thread of %s", listener.source)
+            listener.join(max(0, deadline - time.monotonic()))
+    running = [listener.source for listener in listeners
+               if listener.is_alive()]
+    if running:
+        logger.warning("Listeners did not stop in time: %s", running)
+    else:
+        logger.info("Listener threads joined")
+
+
+def start_replication():
+    # the listeners and receiver monitors of every source, for main() and
+    # the Windows service alike
+    from db import listener_threads, receiver_monitors
+
+    listeners.extend(listener_threads())
+    receiver_monitors()
+
+
+def stop_replication():
+    from db import stop_event_processing
+
+    stop_event_processing()
+    logger.info("Stopping the service gracefully")
+    join_listeners()
+
+
+def shutdown():
+    try:
+        stop_replication()
         sys.exit(0)
     except Exception as e:
         logger.error("Exiting failed: %s", e)
@@ -38,19 +81,33 @@ def setup_signal_handlers():
     signal.signal(signal.SIGINT, signal_handler)  # Handle Ctrl+C
     if platform.system() == "Windows":
         signal.signal(signal.SIGBREAK, signal_handler)  # Handle Ctrl+Break
+    else:
+        signal.signal(signal.SIGHUP, reload_handler)  # Reload the config
     signal.signal(signal.SIGTERM, signal_handler)  # Handle termination signals
 
 
-if __name__ == "__main__":
+def main():
+    from waitress import serve
+
+    setup_logging()
     setup_signal_handlers()
-    listener = listener_thread()
+    app = create_app()
+    start_replication()
     try:
-        serve(app, host="0.0.0.0", port=config["webservice"]["port"])
+        serve(
+            app,
+            host="0.0.0.0",
+            port=config["webservice"]["port"],
+            threads=config["webservice"].get("threads", 8),
+        )
     except KeyboardInterrupt:
         logger.info("KeyboardInterrupt received")
         shutdown()
     except Exception as e:
         logger.error("Error running the app: %s", e)
     finally:
-        if listener.is_alive():
-            listener.join()
+        join_listeners()
+
+
+if __name__ == "__main__":
+    main()
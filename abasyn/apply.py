@@ -0,0 +1,183 @@
+import time
+import record
+import tracing
+from backend import block_size
+from sysutils import logger
+
+# Firebird refuses statement texts longer than 64 KB, leave some room for
+# the execute block wrapper
+BLOCK_LIMIT = 65535 - 32
+# prepared statements kept per connection
+PREPARED_LIMIT = 256
+
+
+class ApplyEngine:
+    def __init__(
+        self,
+        connection,
+        backend,
+        group_size=50,
+        commit_rows=1000,
+        commit_interval=500,
+        on_commit=None,
+        checkpoint=None,
+    ):
+        self.connection = connection
+        self.backend = backend
+        self.cursor = connection.cursor()
+        self.group_size = max(1, group_size)
+        self.commit_rows = max(1, commit_rows)
+        self.commit_interval = commit_interval / 1000
+        self.on_commit = on_commit
+        # checkpoint(cursor, last_id) writes the position on the receiver,
+        # in the transaction it describes
+        self.checkpoint = checkpoint
+        self.group = []
+        self.group_bytes = 0
+        # change records, applied as a group of parameterized statements
+        self.records = []
+        self.records_params = 0
+        self.records_bytes = 0
+        self.records_message = 0
+        self.prepared = {}
+        self.uncommitted = 0
+        self.last_id = None
+        self.committed_id = None
+        self.rows_committed = 0
+        self.commits = 0
+        self.commit_seconds = 0
+        self.last_commit = time.monotonic()
+        # changes up to this id may already be on the receiver, e.g. from a
+        # seed snapshot, so they go one by one and failures are skipped
+        self.tolerant_until = 0
+        self.skipped = 0
+
+    def apply(self, change_id, sql):
+        sql = sql.strip().rstrip(";")
+        if change_id <= self.tolerant_until:
+            self.apply_tolerant(change_id, sql)
+        elif record.is_record(sql):
+            statement, params = record.bind(sql)
+            # both the block text and its input message are limited
+            text, message = block_size(statement, params, self.records_params)
+            if self.group or (self.records and (
+                len(self.records) >= self.group_size
+                or self.records_bytes + text > BLOCK_LIMIT
+                or self.records_message + message > BLOCK_LIMIT
+            )):
+                self.flush()
+                text, message = block_size(statement, params)
+            self.records.append((statement, params))
+            self.records_params += len(params)
+            self.records_bytes += text
+            self.records_message += message
+        else:
+            if self.records:
+                self.flush()
+            size = len(sql.encode("utf-8")) + 2
+            if self.group and (
+                len(self.group) >= self.group_size
+                or self.group_bytes + size > BLOCK_LIMIT
+            ):
+                self.flush()
+            self.group.append(sql)
+            self.group_bytes += size
+        self.last_id = change_id
+        self.uncommitted += 1
+        if (
+            self.uncommitted >= self.commit_rows
+            or time.monotonic() - self.last_commit >= self.commit_interval
+        ):
+            self.commit()
+
+    def apply_tolerant(self, change_id, sql):
+        self.flush()
+        try:
+            if record.is_record(sql):
+                statement, params = record.bind(sql)
+                self.cursor.execute(self.prepare(statement), params)
+            else:
+                self.cursor.execute(sql)
+        except self.backend.DatabaseError as e:
+            self.skipped += 1
+            logger.debug("Skipped change %s already applied: %s", change_id, e)
+
+    def advance(self, change_id):
+        # changes dropped before apply still move the position forward
+        self.last_id = change_id
+
+    def prepare(self, sql):
+        prepared = self.prepared.get(sql)
+        if prepared is None:
+            if len(self.prepared) >= PREPARED_LIMIT:
+                self.prepared.clear()
+            prepared = self.prepared[sql] = self.backend.prepare(
+                self.cursor, sql
+            )
+        return prepared
+
+    def flush(self):
+        if self.records:
+            self.flush_records()
+        if not self.group:
+            return
+        if tracing.active:
+            started = time.perf_counter()
+        if len(self.group) == 1:
+            self.cursor.execute(self.group[0])
+        else:
+            self.backend.execute_block(self.cursor, self.group)
+        if tracing.active:
+            tracing.record_statements(
+                self.group, time.perf_counter() - started
+            )
+        self.group = []
+        self.group_bytes = 0
+
+    def flush_records(self):
+        if tracing.active:
+            started = time.perf_counter()
+        if len(self.records) == 1:
+            statement, params = self.records[0]
+            self.cursor.execute(self.prepare(statement), params)
+        else:
+            self.backend.execute_records(
+                self.cursor, self.records, self.prepare
+            )
+        if tracing.active:
+            tracing.record_statements(
+                [statement for statement, params in self.records],
+                time.perf_counter() - started,
+            )
+        self.records = []
+        self.records_params = 0
+        self.records_bytes = 0
+        self.records_message = 0
+
+    def commit(self):
+        self.flush()
+        if self.uncommitted or self.last_id != self.committed_id:
+            started = time.perf_counter()
+            if self.checkpoint is not None:
+                self.checkpoint(self.cursor, self.last_id)
+            self.connection.commit()
+            self.commit_seconds = time.perf_counter() - started
+            self.commits += 1
+            self.committed_id = self.last_id
+            self.rows_committed += self.uncommitted
+            self.uncommitted = 0
+            logger.debug("Committed changes up to %s", self.committed_id)
+            if self.on_commit is not None:
+                self.on_commit(self.committed_id)
+        self.last_commit = time.monotonic()
+
+    def rollback(self):
+        self.group = []
+        self.group_bytes = 0
+        self.records = []
+        self.records_params = 0
+        self.records_bytes = 0
+        self.records_message = 0
+        self.uncommitted = 0
+        self.last_id = self.committed_id
+        self.connection.rollback()
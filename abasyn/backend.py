@@ -0,0 +1,373 @@
+import importlib
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from sysutils import config
+
+# Database drivers used by connect_to_database. "fdb" talks to Firebird,
+# "sqlite" is an in-process stand-in for benchmarks and offline runs: it
+# understands the few Firebird specific constructs abasyn itself issues and
+# can add a simulated network round trip to every call.
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+class FdbBackend:
+    name = "fdb"
+
+    def __init__(self, **options):
+        self.options = options
+        self._module = None
+
+    @property
+    def module(self):
+        if self._module is None:
+            self._module = importlib.import_module("fdb")
+        return self._module
+
+    @property
+    def Error(self):
+        return self.module.fbcore.Error
+
+    @property
+    def DatabaseError(self):
+        return self.module.fbcore.DatabaseError
+
+    def connect(self, dsn, user, password):
+        return self.module.connect(
+            dsn=dsn, user=user, password=password, charset="UTF8"
+        )
+
+    def execute_block(self, cursor, statements):
+        # one round trip and one parse for the whole group
+        body = "".join(f"{sql};\n" for sql in statements)
+        cursor.execute("execute block as begin\n" + body + "end")
+
+    def execute_records(self, cursor, records, prepare):
+        # parameterized statements as an execute block with typed input
+        # parameters, one round trip; the block text only depends on the
+        # shapes of the records, so a recurring sequence is prepared once
+        declarations = []
+        body = []
+        params = []
+        for sql, values in records:
+            parts = sql.split("?")
+            text = parts[0]
+            for part, value in zip(parts[1:], values):
+                name = f"p{len(params)}"
+                declarations.append(block_declaration(name, value))
+                params.append(value)
+                text += f":{name}{part}"
+            body.append(f"{text};\n")
+        block = (
+            "execute block (" + ", ".join(declarations) + ")\nas begin\n"
+            + "".join(body) + "end"
+        )
+        cursor.execute(prepare(block), params)
+
+    def prepare(self, cursor, sql):
+        return cursor.prep(sql)
+
+    def lock_timeout(self, connection, seconds):
+        # transactions started from now on give up waiting for a locked
+        # row after seconds, otherwise like fdb's default read committed;
+        # the open one, if any, keeps waiting
+        fdb = self.module
+        tpb = fdb.TPB()
+        tpb.isolation_level = (
+            fdb.isc_tpb_read_committed, fdb.isc_tpb_rec_version
+        )
+        tpb.lock_timeout = seconds
+        # cursors run in the main transaction, which took its own copy of
+        # the connection's TPB when the connection was opened
+        connection.main_transaction.default_tpb = tpb.render()
+
+    def primary_key(self, cursor, table):
+        sql = (
+            "select s.rdb$field_name from rdb$relation_constraints c "
+            "join rdb$index_segments s on s.rdb$index_name = c.rdb$index_name "
+            "where c.rdb$relation_name = ? "
+            "and c.rdb$constraint_type = 'PRIMARY KEY' "
+            "order by s.rdb$field_position"
+        )
+        cursor.execute(sql, [table.upper()])
+        return [row[0].strip() for row in cursor.fetchall()]
+
+
+def block_declaration(name, value):
+    return f"{name} {block_type(value)} = ?"
+
+
+def block_size(sql, params, first=0):
+    # (text, message) bytes a parameterized statement adds to the execute
+    # block of FdbBackend.execute_records, its parameters numbered from
+    # first: the declarations, the :pN placeholders and the statement
+    # itself, and the declared sizes in the input message, UTF8 strings
+    # at four bytes a character
+    text = len(sql.encode("utf-8")) + 2 - len(params)
+    message = 0
+    for number, value in enumerate(params, first):
+        declared = block_type(value)
+        # "pN type = ?, " and ":pN"
+        text += 2 * len(str(number)) + len(declared) + 10
+        if declared[0] == "v":
+            message += 4 * int(declared[8:-1]) + 2
+        else:
+            message += 8
+        # null indicator and alignment
+        message += 4
+    return text, message
+
+
+def block_type(value):
+    # type of an execute block parameter carrying the value
+    if value is None:
+        return "varchar(1)"
+    if isinstance(value, int):
+        return "bigint"
+    if isinstance(value, float):
+        return "double precision"
+    if isinstance(value, bytes):
+        return "blob"
+    if len(value) > 1024:
+        return "blob sub_type text"
+    size = 32
+    while size < len(value):
+        size *= 2
+    return f"varchar({size})"
+
+
+class SqliteCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.connection.cursor()
+
+    def execute(self, sql, params=()):
+        self.connection.roundtrip()
+        match = POST_EVENT.match(sql)
+        if match:
+            # posted right away rather than on commit
+            self.connection.backend.post_event(match.group(1))
+            sql = None
+        else:
+            sql, params = translate(sql, params)
+        if sql is None:
+            self.cursor.execute("select 1")
+        else:
+            self.cursor.execute(sql, params)
+        self.connection.statements += 1
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self.connection.roundtrip()
+        sql, _ = translate(sql, ())
+        self.cursor.executemany(sql, seq_of_params)
+        self.connection.statements += 1
+        return self
+
+    def execute_block(self, statements):
+        self.connection.roundtrip()
+        for sql in statements:
+            self.cursor.execute(translate(sql, ())[0])
+        self.connection.statements += len(statements)
+
+    def execute_records(self, records):
+        self.connection.roundtrip()
+        statements = {sql for sql, params in records}
+        if len(statements) == 1:
+            sql, _ = translate(statements.pop(), ())
+            self.cursor.executemany(sql, [params for _, params in records])
+        else:
+            for sql, params in records:
+                self.cursor.execute(translate(sql, ())[0], params)
+        self.connection.statements += len(records)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+class SqliteEventConduit:
+    def __init__(self, backend, events):
+        self.backend = backend
+        self.events = events
+        self.seen = dict(backend.posted)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def wait(self, timeout=None):
+        with self.backend.condition:
+            self.backend.condition.wait_for(self.pending, timeout)
+            counts = {}
+            for name in self.events:
+                posted = self.backend.posted.get(name, 0)
+                counts[name] = posted - self.seen.get(name, 0)
+                self.seen[name] = posted
+            return counts
+
+    def pending(self):
+        return any(
+            self.backend.posted.get(name, 0) > self.seen.get(name, 0)
+            for name in self.events
+        )
+
+
+class SqliteConnection:
+    def __init__(self, backend, dsn):
+        self.backend = backend
+        self.dsn = dsn
+        self.connection = sqlite3.connect(
+            dsn, timeout=backend.timeout, check_same_thread=False,
+            uri=dsn.startswith("file:"),
+        )
+        self.connection.create_function("hash", 1, sqlite_hash)
+        self.connection.create_function("bin_and", 2, lambda a, b: a & b)
+        self.statements = 0
+
+    def roundtrip(self):
+        if self.backend.latency:
+            time.sleep(self.backend.latency)
+
+    def cursor(self):
+        return SqliteCursor(self)
+
+    def commit(self):
+        self.roundtrip()
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.backend.executed += self.statements
+        self.statements = 0
+        self.connection.close()
+
+    def event_conduit(self, events):
+        return SqliteEventConduit(self.backend, events)
+
+
+class SqliteBackend:
+    name = "sqlite"
+    Error = sqlite3.Error
+    DatabaseError = sqlite3.DatabaseError
+
+    def __init__(self, latency=0, timeout=60, **options):
+        # latency is in seconds, added to every statement and commit;
+        # timeout is how long a writer waits for a locked database
+        self.latency = latency
+        self.timeout = timeout
+        self.options = options
+        self.condition = threading.Condition()
+        self.posted = {}
+        self.executed = 0
+
+    def connect(self, dsn, user, password):
+        return SqliteConnection(self, dsn)
+
+    def execute_block(self, cursor, statements):
+        cursor.execute_block(statements)
+
+    def execute_records(self, cursor, records, prepare):
+        cursor.execute_records(records)
+
+    def prepare(self, cursor, sql):
+        # sqlite3 keeps its own statement cache
+        return sql
+
+    def lock_timeout(self, connection, seconds):
+        connection.connection.execute(
+            f"pragma busy_timeout = {int(seconds * 1000)}"
+        )
+
+    def primary_key(self, cursor, table):
+        cursor.cursor.execute(f"pragma table_info({table})")
+        columns = [row for row in cursor.cursor.fetchall() if row[5]]
+        return [row[1] for row in sorted(columns, key=lambda row: row[5])]
+
+    def post_event(self, name, count=1):
+        with self.condition:
+            self.posted[name] = self.posted.get(name, 0) + count
+            self.condition.notify_all()
+
+
+def sqlite_hash(value):
+    return zlib.crc32(str(value).encode("utf-8"))
+
+
+TRANSLATIONS = (
+    (re.compile(r"^\s*select rdb\$set_context\(.*", re.I | re.S), None),
+    (re.compile(r"^\s*execute procedure .*", re.I | re.S), None),
+    (re.compile(r"\s+from rdb\$database\s*$", re.I), ""),
+    (re.compile(r"\s+rows \?\s*$", re.I), " limit ?"),
+    (re.compile(r"^(\s*select) first (\d+) (.*)$", re.I | re.S),
+     r"\1 \3 limit \2"),
+    (re.compile(r"^\s*update or insert into (.*?)\s+matching\s*\(.*\)\s*$",
+                re.I | re.S),
+     r"insert or replace into \1"),
+)
+
+
+POST_EVENT = re.compile(
+    r"^\s*execute block as begin post_event '(\w+)'; end\s*$", re.I
+)
+
+
+def translate(sql, params):
+    for pattern, replacement in TRANSLATIONS:
+        if replacement is None:
+            if pattern.match(sql):
+                return None, ()
+        else:
+            sql = pattern.sub(replacement, sql)
+    return sql, params
+
+
+BACKENDS = {
+    "fdb": FdbBackend,
+    "sqlite": SqliteBackend,
+}
+
+
+def get_backend():
+    global _backend
+    if _backend is not None:
+        return _backend
+    with _backend_lock:
+        if _backend is None:
+            options = dict(config.get("backend") or {"name": "fdb"})
+            _backend = BACKENDS[options.pop("name", "fdb")](**options)
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        _backend = backend
+    return backend
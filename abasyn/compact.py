@@ -0,0 +1,225 @@
+import re
+import record
+
+# Compaction of a pulled rpl_log batch before it is applied. Only tables
+# replicated with RPL_ALLFIELDS = 1 take part: their updates carry the whole
+# row, so only the last update of a key matters, and a row both inserted
+# and deleted within the batch never has to reach the receiver. Statements
+# on other keys keep their relative order. Change records (see record.py)
+# take part too, but their updates only carry the changed columns:
+# successive record updates of a key are merged into the last one, and
+# one following a full row update is kept along with it. Keys of records
+# are typed values and those of statements literal text, so switching
+# between the two on a table is a barrier like an unknown statement.
+
+INSERT = re.compile(
+    r'^\s*insert\s+into\s+"?(\w+)"?\s*\((.*?)\)\s*values\s*\((.*)\)\s*;?\s*$',
+    re.I | re.S,
+)
+UPDATE = re.compile(
+    r'^\s*update\s+"?(\w+)"?\s+set\s+(.*)\s+where\s+(.*?)\s*;?\s*$',
+    re.I | re.S,
+)
+DELETE = re.compile(
+    r'^\s*delete\s+from\s+"?(\w+)"?\s+where\s+(.*?)\s*;?\s*$', re.I | re.S
+)
+TABLE = re.compile(
+    r'^\s*(?:insert\s+into|update\s+or\s+insert\s+into|update|delete\s+from)'
+    r'\s+"?(\w+)',
+    re.I,
+)
+CONDITION = re.compile(
+    r"""\s*"?(\w+)"?\s*=\s*('(?:[^']|'')*'|[^\s']+)\s*(and\b|$)""",
+    re.I | re.S,
+)
+
+
+def split_top_level(text):
+    # split on commas outside of quotes and parentheses
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    for pos, char in enumerate(text):
+        if char == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(text[start:pos].strip())
+            start = pos + 1
+    parts.append(text[start:].strip())
+    return parts
+
+
+def parse_condition(text):
+    result = {}
+    pos = 0
+    while pos < len(text):
+        match = CONDITION.match(text, pos)
+        if match is None:
+            return None
+        result[match.group(1).upper()] = match.group(2)
+        pos = match.end()
+        if not match.group(3):
+            break
+    return result or None
+
+
+def parse_record(text):
+    try:
+        table, op, key, values = record.decode(text)
+    except ValueError:
+        return None
+    if op == "upsert":
+        return None
+    if op == "insert":
+        columns = dict(values, **key)
+    else:
+        columns = key
+    # values compared as keys have to be hashable
+    if any(isinstance(item, (list, dict)) for item in columns.values()):
+        return None
+    # an update moving the row to another key is left alone
+    if op == "update" and any(
+        column in key and item != key[column]
+        for column, item in values.items()
+    ):
+        return None
+    return op, table, columns
+
+
+def parse(sql):
+    # (operation, table, column values) or None for anything unexpected
+    if record.is_record(sql):
+        return parse_record(sql)
+    match = INSERT.match(sql)
+    if match:
+        columns = [c.strip('" ').upper() for c in match.group(2).split(",")]
+        values = split_top_level(match.group(3))
+        if len(columns) != len(values):
+            return None
+        return "insert", match.group(1).lower(), dict(zip(columns, values))
+    match = UPDATE.match(sql)
+    if match:
+        key = parse_condition(match.group(3))
+        if key is None:
+            return None
+        for assignment in split_top_level(match.group(2)):
+            column, _, value = assignment.partition("=")
+            column = column.strip('" ').upper()
+            # an update moving the row to another key is left alone
+            if column in key and value.strip() != key[column]:
+                return None
+        return "update", match.group(1).lower(), key
+    match = DELETE.match(sql)
+    if match:
+        key = parse_condition(match.group(2))
+        if key is None:
+            return None
+        return "delete", match.group(1).lower(), key
+    return None
+
+
+class Compactor:
+    def __init__(self, tables):
+        self.tables = set(tables)
+        self.key_columns = {}
+        self.received = 0
+        self.applied = 0
+
+    def ratio(self):
+        return round(self.applied / self.received, 3) if self.received else 1
+
+    def key(self, operation, table, values):
+        if operation == "insert":
+            columns = self.key_columns.get(table)
+            if columns is None or not all(c in values for c in columns):
+                return None
+            return tuple(values[c] for c in columns)
+        columns = tuple(sorted(values))
+        # inserts are matched on the columns updates and deletes filter by
+        self.key_columns.setdefault(table, columns)
+        if self.key_columns[table] != columns:
+            return None
+        return tuple(values[c] for c in columns)
+
+    def compact(self, changes):
+        kept = [True] * len(changes)
+        state = {}
+        # merged change records by index
+        texts = {}
+        # whether the last change of each table was a record
+        formats = {}
+        for index, (change_id, sql) in enumerate(changes):
+            parsed = parse(sql)
+            if parsed is None:
+                # unknown statements are barriers for their table
+                if record.is_record(sql):
+                    table = record.table(sql)
+                else:
+                    match = TABLE.match(sql)
+                    table = match.group(1).lower() if match else None
+                if table is None:
+                    state.clear()
+                else:
+                    for entry in [e for e in state if e[0] == table]:
+                        del state[entry]
+                continue
+            operation, table, values = parsed
+            if table not in self.tables:
+                continue
+            is_record = record.is_record(sql)
+            if formats.setdefault(table, is_record) != is_record:
+                formats[table] = is_record
+                for entry in [e for e in state if e[0] == table]:
+                    del state[entry]
+            key = self.key(operation, table, values)
+            if key is None:
+                for entry in [e for e in state if e[0] == table]:
+                    del state[entry]
+                continue
+            entry = state.get((table, key))
+            if operation == "insert":
+                state[(table, key)] = {"insert": index, "updates": []}
+            elif operation == "update":
+                if entry is None:
+                    entry = state[(table, key)] = {
+                        "insert": None, "updates": [],
+                    }
+                if record.is_record(sql):
+                    if not all(
+                        record.is_record(changes[previous][1])
+                        for previous in entry["updates"]
+                    ):
+                        entry["updates"].append(index)
+                        continue
+                    if entry["updates"]:
+                        texts[index] = record.merge(
+                            [texts.get(previous, changes[previous][1])
+                             for previous in entry["updates"]] + [sql]
+                        )
+                # the last full row update wins
+                for previous in entry["updates"]:
+                    kept[previous] = False
+                entry["updates"] = [index]
+            else:
+                if entry is not None:
+                    for previous in entry["updates"]:
+                        kept[previous] = False
+                    if entry["insert"] is not None:
+                        kept[entry["insert"]] = False
+                        kept[index] = False
+                    del state[(table, key)]
+        result = [
+            (change_id, texts.get(index, sql))
+            for index, ((change_id, sql), keep)
+            in enumerate(zip(changes, kept)) if keep
+        ]
+        self.received += len(changes)
+        self.applied += len(result)
+        return result
@@ -1,122 +1,666 @@
 import threading
-import queue
 import time
 import datetime
-import fdb
+import gzip
+import json
+import os
+import random
+from apply import ApplyEngine
+from backend import get_backend
+from compact import Compactor
+from parallel import ParallelEngine
+from spool import Spool
+from cache import SizedCache
+from diff import common_prefix, diff_operations
+import metrics
+import seed
+import tracing
+from pool import ConnectionPool
 from sysutils import logger, config
-import platform
+from concurrent.futures import ThreadPoolExecutor
 
-event_queue = queue.Queue()
 stop_event = threading.Event()
 lock = threading.Lock()
-_listener_thread = None
+_listeners = {}
+_consistency_scans = {}
+_local_pools = {}
+_receiver_monitors = {}
+_rpl_log_heads = {}
+# monotonic time until which stopping workers may finish their batch
+_drain_deadline = None
+_handoffs = {}
+_history_cache = None
+
+BATCH_SIZE = metrics.Histogram(
+    "abasyn_batch_size_rows", "Rows pulled from rpl_log per batch",
+    ("receiver",), metrics.SIZE_BUCKETS,
+)
+PULL_LATENCY = metrics.Histogram(
+    "abasyn_pull_seconds", "Time to read a batch from rpl_log",
+    ("receiver",),
+)
+APPLY_LATENCY = metrics.Histogram(
+    "abasyn_apply_seconds", "Time to apply a batch on the receiver",
+    ("receiver",),
+)
+COMMIT_LATENCY = metrics.Histogram(
+    "abasyn_commit_seconds", "Time of a commit on the receiver",
+    ("receiver",),
+)
+RECORDS_APPLIED = metrics.Counter(
+    "abasyn_records_applied_total", "Changes committed on the receiver",
+    ("receiver",),
+)
+ROWS_PURGED = metrics.Counter(
+    "abasyn_rpl_log_purged_total", "Rows deleted from rpl_log",
+)
+PURGE_SECONDS = metrics.Counter(
+    "abasyn_rpl_log_purge_seconds_total", "Time spent deleting from rpl_log",
+)
+COMPACTED = metrics.Counter(
+    "abasyn_compacted_total", "Changes dropped by compaction before apply",
+    ("receiver",),
+)
+EVENTS_RECEIVED = metrics.Counter(
+    "abasyn_events_received_total", "Replicate events posted by Firebird",
+)
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CoalescingQueue:
+    # Collapses any number of pending events into a single wakeup
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = 0
+
+    def put(self, count=1):
+        with self.condition:
+            self.pending += count
+            self.condition.notify_all()
+
+    def take(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending, timeout)
+            count, self.pending = self.pending, 0
+            return count
+
+    def qsize(self):
+        return self.pending
 
 
 class ProcessingThread(threading.Thread):
-    def __init__(self, local_connect, remote_dbconf):
-        super().__init__()
-        self.local_connect = local_connect
-        self.remote_dbconf = remote_dbconf
+    def __init__(self, receiver, source=None):
+        super().__init__(daemon=True)
+        (self.receiver_id, self.alias, self.dsn, self.user, self.password,
+         self.last_id) = receiver
+        self.source = source_name(source)
+        self.database = source_database(self.source)
+        # aliases are only unique within a source
+        self.label = receiver_label(self.source, self.alias)
+        self.queue = CoalescingQueue()
+        self.stopped = threading.Event()
+        self.local_connect = None
         self.remote_connect = None
+        self.extra_connects = []
+        self.executor = None
+        self.engine = None
+        self.tables = {}
+        self.compactor = None
+        self.spool = open_spool(self.receiver_id, self.source)
+        self.replaying = False
+        self.offline = False
+        self.state = "idle"
+        self.events_processed = 0
+        self.runs = 0
         self.records_processed = 0
+        self.run_records = 0
+        self.batch_size = None
+        self.checkpoint = None
+        self.tolerant_until = 0
+        self.failures = 0
+        self.retry_at = None
+        self.commit_interval = None
+        self.deadline = None
+        self.configure()
+        self.started = None
+        self.finished = None
+        self.last_rate = 0
+        self.behind_since = None
+        self.connected_since = None
+        self.take_over()
 
-    def run(self):
-        dsn, user, password, last_id = self.remote_dbconf
-        self.remote_connect = connect_to_database(dsn, user, password)
-        if self.remote_connect is None:
+    def configure(self):
+        # picked up by the next run, compaction by the next connection
+        self.settings = config.get("replication", {})
+        self.parallel = max(1, self.settings.get("parallel", 1))
+        self.lock_timeout = self.settings.get("parallel_lock_timeout", 3)
+        self.checkpoints = self.settings.get("checkpoint", True)
+        self.adaptive = self.settings.get("adaptive", True)
+        self.min_batch_size = self.settings.get("min_batch_size", 50)
+        self.max_batch_size = self.settings.get("max_batch_size", 10000)
+        self.target_seconds = self.settings.get("target_batch_seconds", 2)
+        self.min_commit_interval = self.settings.get("commit_interval", 500)
+        self.max_commit_interval = self.settings.get(
+            "max_commit_interval", 5000
+        )
+        self.retry_min = self.settings.get("retry_min", 1)
+        self.retry_max = self.settings.get("retry_max", 300)
+        if self.batch_size is None or not self.adaptive:
+            self.batch_size = self.settings.get("batch_size", 1000)
+        self.batch_size = min(
+            max(self.batch_size, self.min_batch_size), self.max_batch_size
+        )
+        if self.commit_interval is None or not self.adaptive:
+            self.commit_interval = self.min_commit_interval
+
+    def take_over(self):
+        # adaptive and retry state left by the previous process
+        state = load_handoff(self.source).pop(str(self.receiver_id), None)
+        if not state or state["alias"] != self.alias:
             return
-        try:
-            while not stop_event.is_set() and not event_queue.empty():
-                event = event_queue.get()
-                logger.info(
-                    f"Received event {event}, "
-                    f"process everything above {last_id}"
+        if self.adaptive:
+            self.batch_size = min(
+                max(state["batch_size"], self.min_batch_size),
+                self.max_batch_size,
+            )
+            self.commit_interval = min(
+                max(state["commit_interval"], self.min_commit_interval),
+                self.max_commit_interval,
+            )
+        self.offline = state["offline"]
+        self.failures = state["failures"]
+
+    def handoff(self):
+        # tuning only, the position comes from rpl_databases and the
+        # receiver's checkpoint
+        return {
+            "alias": self.alias,
+            "batch_size": self.batch_size,
+            "commit_interval": self.commit_interval,
+            "offline": self.offline,
+            "failures": self.failures,
+        }
+
+    def cancelled(self):
+        # stopping, and the time to finish the current batch is up
+        if self.stopped.is_set():
+            deadline = self.deadline
+        elif stop_event.is_set():
+            deadline = _drain_deadline
+        else:
+            return False
+        return deadline is None or time.monotonic() >= deadline
+
+    def adapt(self, rows, seconds):
+        # like TCP congestion control: a page slower than the target halves
+        # the batch, quick full pages grow it by a quarter
+        if not self.adaptive:
+            return
+        if seconds > self.target_seconds:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        elif rows >= self.batch_size and seconds < self.target_seconds / 2:
+            self.batch_size = min(
+                self.max_batch_size,
+                self.batch_size + max(1, self.batch_size // 4),
+            )
+
+    def backoff(self):
+        # exponential with jitter, so failing receivers do not retry in step
+        self.failures += 1
+        if self.adaptive:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        delay = min(
+            self.retry_max, self.retry_min * 2 ** min(self.failures - 1, 16)
+        )
+        delay *= random.uniform(0.5, 1)
+        self.retry_at = time.time() + delay
+        # nothing is held while waiting, the janitor may trim rpl_log
+        self.state = "offline" if self.offline else "retrying"
+        stop_event.wait(delay)
+        self.retry_at = None
+
+    def rows_per_sec(self):
+        # rate of the current run, or of the last one which did any work
+        if self.finished is not None or self.started is None:
+            return self.last_rate
+        elapsed = time.time() - self.started
+        return round(self.run_records / elapsed, 1) if elapsed else 0
+
+    def pull(self, localcur, position):
+        # keyset pagination keeps memory flat regardless of the backlog
+        sql = ("select id, rpl_sql from rpl_log "
+               "where id > ? order by id rows ?")
+        localcur.execute(sql, [position, self.batch_size])
+        changes = localcur.fetchall()
+        self.local_connect.rollback()
+        return changes
+
+    def idle(self):
+        # an offline or seeding receiver keeps its retry queued but holds
+        # nothing up
+        if self.state in ("offline", "retrying"):
+            return True
+        return self.state == "idle" and (
+            self.offline
+            or not self.queue.qsize()
+            or seed.in_progress(self.receiver_id, self.source)
+        )
+
+    def advance_master(self, last_id):
+        cur = self.local_connect.cursor()
+        sql = "update rpl_databases set last_id = ? where id = ?"
+        cur.execute(sql, [last_id, self.receiver_id])
+        self.local_connect.commit()
+        self.last_id = last_id
+
+    def save_position(self, last_id):
+        # the receiver has just committed everything up to last_id
+        if self.replaying:
+            self.spool.acknowledge(last_id)
+        else:
+            self.advance_master(last_id)
+        committed = self.engine.rows_committed - self.run_records
+        self.records_processed += committed
+        self.run_records = self.engine.rows_committed
+        COMMIT_LATENCY.observe(self.engine.commit_seconds, self.label)
+        tracing.record(
+            "commit", self.label, self.engine.commit_seconds, committed
+        )
+        if self.adaptive:
+            # commits should take about a tenth of the time
+            self.commit_interval = min(
+                max(self.engine.commit_seconds * 10000,
+                    self.min_commit_interval),
+                self.max_commit_interval,
+            )
+            self.engine.commit_interval = self.commit_interval / 1000
+        RECORDS_APPLIED.inc(self.label, amount=committed)
+
+    def connect(self):
+        if self.local_connect is None:
+            self.local_connect = connect_to_database(**self.database)
+            if self.local_connect is None:
+                return False
+            self.tables = load_rpl_tables(self.local_connect)
+            if self.settings.get("compaction", False):
+                self.compactor = Compactor(
+                    name for name, (allfields, docheader)
+                    in self.tables.items() if allfields
                 )
-                # pull replication data from local db
-                localcur = self.local_connect.cursor()
-                sql = ("select id, rpl_sql from rpl_log "
-                       "where id > ? order by id")
-                localcur.execute(sql, [last_id])
-                changes = localcur.fetchall()
-                self.local_connect.rollback()
-                # push replication data to remote db
-                remotecur = self.remote_connect.cursor()
-                sql = (
-                    "select rdb$set_context('USER_SESSION', "
-                    "'replicating_now', 1) from rdb$database"
+        if self.remote_connect is None:
+            self.state = "connecting"
+            # a single attempt, retries are paced by backoff()
+            self.remote_connect = open_receiver(
+                self.dsn, self.user, self.password, timeout=0
+            )
+            if self.remote_connect is None:
+                return False
+            if self.parallel > 1:
+                get_backend().lock_timeout(
+                    self.remote_connect, self.lock_timeout
                 )
-                remotecur.execute(sql)
-                for change in changes:
-                    logger.debug(f"Pushing change: {change[1]}")
-                    remotecur.execute(change[1])
-                    self.records_processed += 1
-                    last_pushed_id = change[0]
-                self.remote_connect.commit()
-                logger.info(f"Pushed {self.records_processed} records")
-                # clean up local db
-                sql = "update rpl_databases set last_id = ?"
-                localcur.execute(sql, [last_pushed_id])
-                sql = (
-                    "delete from rpl_log where id <= (select min(last_id)"
-                    " from rpl_databases)"
+            self.connected_since = datetime.datetime.now().strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+            if self.checkpoints:
+                self.resume()
+        while len(self.extra_connects) < self.parallel - 1:
+            con = open_receiver(
+                self.dsn, self.user, self.password, timeout=0
+            )
+            if con is None:
+                return False
+            # a partition waiting for a row locked by another one would
+            # wait for a commit that only comes after it finished
+            get_backend().lock_timeout(con, self.lock_timeout)
+            self.extra_connects.append(con)
+        if self.parallel > 1 and self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.parallel, thread_name_prefix=f"apply-{self.label}"
+            )
+        return True
+
+    def resume(self):
+        # the receiver knows best how far it got, the master's last_id lags
+        # behind it when the worker stopped between the two commits
+        slots = read_checkpoints(self.remote_connect, self.source)
+        self.checkpoint = slots.get(0)
+        # other connections of a parallel apply may have got further
+        self.tolerant_until = max(slots.values(), default=0)
+        if self.checkpoint is None:
+            return
+        if self.checkpoint > self.last_id:
+            logger.info(
+                f"Resuming {self.label} from its checkpoint "
+                f"{self.checkpoint}, rpl_databases had {self.last_id}"
+            )
+            self.advance_master(self.checkpoint)
+        if self.spool is not None and self.checkpoint > self.spool.replayed_id:
+            self.spool.acknowledge(self.checkpoint)
+            self.spool.release()
+
+    def write_checkpoint(self, cursor, last_id, slot=0):
+        write_checkpoint(cursor, self.source, last_id, slot)
+        if slot == 0:
+            self.checkpoint = last_id
+
+    def disconnect(self):
+        connections = [self.remote_connect, self.local_connect]
+        for con in connections + self.extra_connects:
+            if con is not None:
+                try:
+                    con.close()
+                except Exception as e:
+                    logger.debug(f"Failed to close connection: {e}")
+        self.remote_connect = None
+        self.local_connect = None
+        self.extra_connects = []
+        self.connected_since = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def spool_changes(self):
+        # move the backlog of an unreachable receiver off the master
+        if self.spool is None or self.local_connect is None:
+            return
+        self.state = "spooling"
+        localcur = self.local_connect.cursor()
+        spooled = 0
+        while not stop_event.is_set() and not self.stopped.is_set():
+            if self.spool.full():
+                logger.warning(
+                    f"Spool of {self.label} is full, keeping the rest "
+                    f"in rpl_log"
                 )
-                localcur.execute(sql)
-                self.local_connect.commit()
-                logger.info("Cleaned up local db")
-        except fdb.fbcore.DatabaseError as e:
-            logger.error(f"Failed to process event, DB error: {e}")
-        except Exception as e:
-            logger.error(f"Failed to process event, error: {e}")
+                break
+            changes = self.pull(localcur, self.last_id)
+            if not changes:
+                break
+            self.spool.append(changes)
+            self.advance_master(changes[-1][0])
+            spooled += len(changes)
+        if spooled:
+            logger.info(f"Spooled {spooled} records for {self.label}")
+
+    def replay_spool(self):
+        logger.info(
+            f"Replaying {self.spool.depth()} spooled records to {self.label}"
+        )
+        self.replaying = True
+        try:
+            for changes in self.spool.replay():
+                if stop_event.is_set() or self.stopped.is_set():
+                    break
+                self.apply_changes(changes)
+            self.engine.commit()
         finally:
-            logger.info("Stopped processing events")
-            self.remote_connect.close()
+            self.replaying = False
+            self.spool.release()
+
+    def apply_changes(self, changes):
+        BATCH_SIZE.observe(len(changes), self.label)
+        if self.compactor is not None:
+            batch = self.compactor.compact(changes)
+            COMPACTED.inc(self.label, amount=len(changes) - len(batch))
+        else:
+            batch = changes
+        started = time.perf_counter()
+        # a stop is noticed between groups of statements
+        step = self.settings.get("group_size", 50)
+        for start in range(0, len(batch), step):
+            if self.cancelled():
+                raise Cancelled()
+            for change_id, rpl_sql in batch[start:start + step]:
+                self.engine.apply(change_id, rpl_sql)
+        self.engine.advance(changes[-1][0])
+        elapsed = time.perf_counter() - started
+        APPLY_LATENCY.observe(elapsed, self.label)
+        tracing.record("apply", self.label, elapsed, len(batch))
+
+    def replicate(self):
+        logger.info(
+            f"Replicating to {self.label}, "
+            f"process everything above {self.last_id}"
+        )
+        self.state = "processing"
+        options = dict(
+            group_size=self.settings.get("group_size", 50),
+            commit_rows=self.settings.get("commit_rows", 1000),
+            commit_interval=self.commit_interval,
+            on_commit=self.save_position,
+            checkpoint=self.write_checkpoint if self.checkpoints else None,
+        )
+        if self.parallel > 1:
+            self.engine = ParallelEngine(
+                [self.remote_connect] + self.extra_connects,
+                self.executor,
+                get_backend(),
+                self.tables,
+                cooldown=self.settings.get("parallel_cooldown", 300),
+                **options,
+            )
+        else:
+            self.engine = ApplyEngine(
+                self.remote_connect, get_backend(), **options
+            )
+        self.engine.tolerant_until = max(
+            seed.tolerant_until(self.receiver_id, self.source),
+            self.tolerant_until,
+        )
+        self.started = time.time()
+        self.finished = None
+        self.run_records = 0
+        try:
+            if self.spool is not None and self.spool.depth():
+                self.replay_spool()
+            localcur = self.local_connect.cursor()
+            position = self.last_id
+            while (
+                not stop_event.is_set()
+                and not self.stopped.is_set()
+                and not seed.in_progress(self.receiver_id, self.source)
+            ):
+                started = time.perf_counter()
+                changes = self.pull(localcur, position)
+                elapsed = time.perf_counter() - started
+                PULL_LATENCY.observe(elapsed, self.label)
+                tracing.record("pull", self.label, elapsed, len(changes))
+                if not changes:
+                    self.behind_since = None
+                    break
+                self.apply_changes(changes)
+                self.adapt(len(changes), time.perf_counter() - started)
+                position = changes[-1][0]
+            self.engine.commit()
+        except Cancelled:
+            # the receiver keeps what was committed, the rest is pulled
+            # again by the next process
+            self.engine.rollback()
+            logger.warning(
+                f"Stopped replicating to {self.label} before the batch "
+                f"was done, rolled back to {self.engine.committed_id}"
+            )
+        self.finished = time.time()
+        self.runs += 1
+        if self.run_records and self.finished > self.started:
+            self.last_rate = round(
+                self.run_records / (self.finished - self.started), 1
+            )
+        logger.info(f"Pushed {self.run_records} records to {self.label}")
+
+    def run(self):
+        while not stop_event.is_set() and not self.stopped.is_set():
+            events = self.queue.take(timeout=1)
+            if not events:
+                continue
+            if seed.in_progress(self.receiver_id, self.source):
+                # the seed moves the position, keep the events until then
+                self.queue.put(events)
+                stop_event.wait(5)
+                continue
+            # events arriving meanwhile are handled by the next iteration
+            self.events_processed += events
+            if self.behind_since is None:
+                self.behind_since = time.time()
+            try:
+                if self.connect():
+                    self.offline = False
+                    with tracing.span("replicate", self.label):
+                        self.replicate()
+                    self.failures = 0
+                else:
+                    self.offline = True
+                    self.spool_changes()
+                    self.queue.put()
+                    self.backoff()
+            except get_backend().DatabaseError as e:
+                logger.error(
+                    f"Failed to replicate to {self.label}, DB error: {e}"
+                )
+                self.disconnect()
+                self.queue.put()
+                self.backoff()
+            except Exception as e:
+                logger.error(
+                    f"Failed to replicate to {self.label}, error: {e}"
+                )
+                self.disconnect()
+                self.queue.put()
+                self.backoff()
+            finally:
+                self.state = "idle"
+        self.disconnect()
+        logger.info(f"Stopped replicating to {self.label}")
+
+    def stop(self, drain=0):
+        self.deadline = time.monotonic() + drain
+        self.stopped.set()
+        self.queue.put()
+
+    def status(self):
+        return {
+            "alias": self.alias,
+            "status": self.state,
+            "last_id": self.last_id,
+            "checkpoint": self.checkpoint,
+            "events_processed": self.events_processed,
+            "runs": self.runs,
+            "records_processed": self.records_processed,
+            "rows_per_sec": self.rows_per_sec(),
+            "compaction_ratio": (
+                self.compactor.ratio() if self.compactor else None
+            ),
+            "connected_since": self.connected_since,
+            "queue_size": self.queue.qsize(),
+            "spool": self.spool.status() if self.spool else None,
+            "batch_size": self.batch_size,
+            "commit_interval": (
+                round(self.engine.commit_interval * 1000)
+                if self.engine else None
+            ),
+            "failures": self.failures,
+            "retry_in": (
+                round(max(0, self.retry_at - time.time()), 1)
+                if self.retry_at else None
+            ),
+            "parallel": self.parallel,
+            "apply_conflicts": getattr(self.engine, "conflicts", 0),
+            "seeding": seed.in_progress(self.receiver_id, self.source),
+        }
 
 
 class ListeningThread(threading.Thread):
-    def __init__(self, event_list):
-        super().__init__()
-        self.masterdb = config["database"]
+    def __init__(self, event_list, source=None):
+        # a daemon, so a conduit stuck in fdb cannot keep the process alive
+        super().__init__(name=f"listener-{source_name(source)}", daemon=True)
+        self.source = source_name(source)
+        self.masterdb = source_database(self.source)
         self.local_conn = None
         self.event_list = event_list
-        self.processing_thread = None
+        # posted by wake() to end a wait on the conduit
+        self.wakeup_event = f"abasyn_stop_{os.getpid()}"
+        self.mode = config.get("replication", {}).get("mode", "events")
+        self.poller = None
+        self.janitor = None
+        self.workers = {}
+        self.workers_lock = threading.Lock()
         self.events_processed = 0
-        self.records_processed = 0
-        self.remote_connect_time = None
 
-    def start_processing(self):
-        cur = self.local_conn.cursor()
-        sql = "SELECT dbname, dbuser, dbpass, last_id FROM rpl_databases"
+    def sync_workers(self, con):
+        # start workers for new receivers and stop the removed ones
+        cur = con.cursor()
+        sql = ("SELECT id, alias, dbname, dbuser, dbpass, last_id "
+               "FROM rpl_databases")
         cur.execute(sql)
-        result = cur.fetchone()
-        self.local_conn.rollback()
-        self.processing_thread = ProcessingThread(self.local_conn, result)
-        self.events_processed += 1
-        self.processing_thread.start()
-        timenow = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.remote_connect_time = timenow
-        self.processing_thread.join()
-        self.records_processed += self.processing_thread.records_processed
-        self.processing_thread = None
+        result = cur.fetchall()
+        con.rollback()
+        receivers = {row[0]: row for row in result}
+        with self.workers_lock:
+            for receiver_id, worker in list(self.workers.items()):
+                if receiver_id not in receivers or not worker.is_alive():
+                    worker.stop()
+                    del self.workers[receiver_id]
+            for receiver_id, row in receivers.items():
+                if receiver_id not in self.workers:
+                    worker = ProcessingThread(row, self.source)
+                    self.workers[receiver_id] = worker
+                    worker.start()
+                    worker.queue.put()
+
+    def reload(self):
+        # settings the running threads can apply without reconnecting
+        mode = config.get("replication", {}).get("mode", "events")
+        if mode != self.mode:
+            logger.warning(
+                f"Replication mode {mode} takes effect after a restart"
+            )
+        for worker in list(self.workers.values()):
+            worker.configure()
+        for helper in (self.poller, self.janitor):
+            if helper is not None:
+                helper.configure()
+                helper.wakeup.set()
+
+    def notify_workers(self, count=1):
+        self.events_processed += count
+        EVENTS_RECEIVED.inc(amount=count)
+        self.sync_workers(self.local_conn)
+        for worker in list(self.workers.values()):
+            worker.queue.put(count)
+        if self.poller is not None:
+            self.poller.activity()
 
     def status(self):
-        if self.processing_thread and self.processing_thread.is_alive():
-            ownstatus = "processing"
-            remote_db_status = {
-                "connected": True,
-                "since": self.remote_connect_time,
-            }
-        else:
-            ownstatus = "listening"
-            remote_db_status = {
-                "connected": False,
-                "last_connect": self.remote_connect_time,
-            }
+        workers = list(self.workers.values())
+        receivers = {worker.alias: worker.status() for worker in workers}
+        processing = any(
+            worker.state == "processing" for worker in workers
+        )
         return {
-            "status": ownstatus,
+            "status": "processing" if processing else "listening",
+            "source": self.source,
+            "mode": self.mode,
+            "poll_interval": self.poller.interval if self.poller else None,
             "events_processed": self.events_processed,
-            "records_processed": self.records_processed,
-            "remote_db_status": remote_db_status,
-            "queue_size": event_queue.qsize(),
+            "records_processed": sum(
+                worker.records_processed for worker in workers
+            ),
+            "rows_per_sec": round(
+                sum(worker.rows_per_sec() for worker in workers), 1
+            ),
+            "remote_db_status": {
+                "connected": any(
+                    worker.connected_since for worker in workers
+                ),
+            },
+            "receivers": receivers,
+            "queue_size": sum(worker.queue.qsize() for worker in workers),
+            "janitor": self.janitor.status() if self.janitor else None,
+            "pool": local_pool(self.source).stats(),
         }
 
     # TODO: Currently there is an issue related to the implementation of the
@@ -126,159 +670,917 @@ class ListeningThread(threading.Thread):
     # If these execeptions are disabled in the fbcore module, class EventBlock,
     # methods `__wait_for_events` and `close` (lines 2067 and 2092), everything
     # works as expected. Google for "fdb errror while waiting for events" and
-    # "fdb error while cancelling events" for details.
+    # "fdb error while cancelling events" for details. The conduit is
+    # therefore never cancelled: to stop, wake() posts an event of its own
+    # which ends the wait, and the conduit is closed after it returned. If
+    # the master cannot be reached for that, the listener is a daemon and
+    # is given up on once the shutdown deadline passes.
+
+    def wake(self):
+        if self.mode == "poll" or not self.is_alive():
+            return
+        try:
+            con = open_connection(**self.masterdb)
+            try:
+                cur = con.cursor()
+                cur.execute(
+                    f"execute block as begin "
+                    f"post_event '{self.wakeup_event}'; end"
+                )
+                con.commit()
+            finally:
+                con.close()
+        except Exception as e:
+            logger.warning(
+                f"Failed to wake the listener of {self.source}: {e}"
+            )
 
     def run(self):
         self.local_conn = connect_to_database(**self.masterdb)
         if self.local_conn is None:
             return
-        logger.info("Started listening for replicate events")
-        if platform.system() == "Windows":
-            timeout = 3
-        else:
-            timeout = None
+        logger.info(f"Started listening for replicate events on {self.source}")
         try:
-            while not stop_event.is_set():
-                with self.local_conn.event_conduit(
-                    self.event_list
-                ) as event_cond:
-                    events = event_cond.wait(timeout)
-                    if (
-                        (events is not None)
-                        and len(events)
-                        and (events.get(self.event_list[0], 0) > 0)
-                    ):
+            self.sync_workers(self.local_conn)
+            self.janitor = JanitorThread(
+                lambda: list(self.workers.values()), self.masterdb
+            )
+            self.janitor.start()
+            if self.mode in ("poll", "hybrid"):
+                self.poller = PollingThread(self)
+                self.poller.start()
+            if self.mode == "poll":
+                stop_event.wait()
+                return
+            # the conduit stays registered while batches are applied, so
+            # no event posted in the meantime is lost
+            events = self.event_list + [self.wakeup_event]
+            with self.local_conn.event_conduit(events) as event_cond:
+                while not stop_event.is_set():
+                    events = event_cond.wait()
+                    count = (events or {}).get(self.event_list[0], 0)
+                    if count > 0:
                         logger.info(f"Received event: {events}")
-                        event_queue.put(events)
-                        if (
-                            self.processing_thread is None
-                            or not self.processing_thread.is_alive()
-                        ):
-                            self.start_processing()
-        except fdb.fbcore.Error as e:
+                        self.notify_workers(count)
+        except get_backend().Error as e:
             logger.error(f"Failed to listen for events, DB error: {e}")
         except Exception as e:
             logger.error(f"Failed to listen for events, error: {e}")
         finally:
-            logger.info("Stopped listening for replicate events")
+            workers = list(self.workers.values())
+            drain = drain_remaining()
+            for worker in workers:
+                worker.stop(drain)
+            # a worker past its deadline is rolling back, give it a moment
+            deadline = time.monotonic() + drain + 5
+            for worker in workers:
+                worker.join(max(0, deadline - time.monotonic()))
+            running = [worker.label for worker in workers if worker.is_alive()]
+            if running:
+                logger.warning(
+                    f"Workers still running at shutdown: {', '.join(running)}"
+                )
+            save_handoff(self.source, workers)
+            self.local_conn.close()
+            logger.info(
+                f"Stopped listening for replicate events on {self.source}"
+            )
+
+
+class PollingThread(threading.Thread):
+    # Finds changes the event subsystem did not tell about. The interval
+    # drops to the minimum while changes are flowing and doubles while idle.
+    def __init__(self, listener):
+        super().__init__(daemon=True)
+        self.listener = listener
+        self.configure()
+        self.interval = self.min_interval
+        self.wakeup = threading.Event()
+        self.local_conn = None
+        self.polls = 0
+
+    def configure(self):
+        settings = config.get("replication", {})
+        self.min_interval = settings.get("poll_min_interval", 1)
+        self.max_interval = settings.get("poll_max_interval", 60)
+
+    def activity(self):
+        self.interval = self.min_interval
+
+    def poll(self):
+        # an index seek per distinct position is cheaper than max(id)
+        self.listener.sync_workers(self.local_conn)
+        cur = self.local_conn.cursor()
+        sql = "select first 1 id from rpl_log where id > ? order by id"
+        behind = False
+        waiting = {}
+        for worker in list(self.listener.workers.values()):
+            if worker.state == "idle":
+                waiting.setdefault(worker.last_id, []).append(worker)
+        for last_id, workers in waiting.items():
+            cur.execute(sql, [last_id])
+            if cur.fetchone() is not None:
+                behind = True
+                for worker in workers:
+                    worker.queue.put()
+        self.local_conn.rollback()
+        self.polls += 1
+        return behind
+
+    def run(self):
+        logger.info(f"Started polling rpl_log every {self.interval}s")
+        while not stop_event.is_set():
+            try:
+                if self.local_conn is None:
+                    self.local_conn = connect_to_database(
+                        **self.listener.masterdb
+                    )
+                if self.local_conn is not None:
+                    if self.poll():
+                        self.interval = self.min_interval
+                    else:
+                        self.interval = min(
+                            self.interval * 2, self.max_interval
+                        )
+            except Exception as e:
+                logger.error(f"Failed to poll rpl_log, error: {e}")
+                try:
+                    self.local_conn.close()
+                except Exception:
+                    pass
+                self.local_conn = None
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+        if self.local_conn is not None:
+            self.local_conn.close()
+        logger.info("Stopped polling rpl_log")
+
+
+class JanitorThread(threading.Thread):
+    # Trims rpl_log up to the slowest receiver in short transactions over
+    # bounded id ranges, only while no receiver is being replicated to.
+    def __init__(self, workers, database=None):
+        super().__init__(daemon=True)
+        self.workers = workers
+        self.database = database
+        self.configure()
+        self.wakeup = threading.Event()
+        self.local_conn = None
+        self.runs = 0
+        self.purged = 0
+        self.seconds = 0.0
+        self.last_run = None
+        self.last_purged = 0
+
+    def configure(self):
+        settings = config.get("janitor", {})
+        self.interval = settings.get("interval", 30)
+        self.chunk_size = settings.get("chunk_size", 5000)
+        self.pause = settings.get("pause", 0.1)
+        self.archive = settings.get("archive")
+
+    def idle(self):
+        return all(worker.idle() for worker in self.workers())
+
+    def archive_chunk(self, cur, low, high):
+        sql = ("select id, rpl_sql from rpl_log "
+               "where id between ? and ? order by id")
+        cur.execute(sql, [low, high])
+        path = datetime.datetime.now().strftime(self.archive)
+        with gzip.open(path, "at", encoding="utf-8") as archive:
+            for change_id, rpl_sql in cur:
+                archive.write(
+                    json.dumps({"id": change_id, "rpl_sql": rpl_sql}) + "\n"
+                )
+
+    def purge(self, con):
+        cur = con.cursor()
+        cur.execute("select min(last_id) from rpl_databases")
+        upto = cur.fetchone()[0]
+        cur.execute("select min(id) from rpl_log")
+        low = cur.fetchone()[0]
+        con.rollback()
+        purged = 0
+        while (
+            upto is not None
+            and low is not None
+            and low <= upto
+            and not stop_event.is_set()
+            and self.idle()
+        ):
+            started = time.perf_counter()
+            high = min(low + self.chunk_size - 1, upto)
+            if self.archive:
+                self.archive_chunk(cur, low, high)
+            cur.execute(
+                "delete from rpl_log where id between ? and ?", [low, high]
+            )
+            deleted = max(cur.rowcount, 0)
+            con.commit()
+            elapsed = time.perf_counter() - started
+            purged += deleted
+            self.purged += deleted
+            self.seconds += elapsed
+            ROWS_PURGED.inc(amount=deleted)
+            PURGE_SECONDS.inc(amount=elapsed)
+            tracing.record("cleanup", "rpl_log", elapsed, deleted)
+            # skip over gaps in the ids with an index seek
+            sql = "select first 1 id from rpl_log where id > ? order by id"
+            cur.execute(sql, [high])
+            row = cur.fetchone()
+            con.rollback()
+            low = row[0] if row else None
+            stop_event.wait(self.pause)
+        self.runs += 1
+        self.last_purged = purged
+        self.last_run = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if purged:
+            logger.info(f"Purged {purged} rows from rpl_log")
+        return purged
+
+    def run(self):
+        while not stop_event.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if stop_event.is_set() or not self.idle():
+                continue
+            try:
+                if self.local_conn is None:
+                    self.local_conn = connect_to_database(**self.database)
+                if self.local_conn is not None:
+                    self.purge(self.local_conn)
+            except Exception as e:
+                logger.error(f"Failed to clean up rpl_log, error: {e}")
+                try:
+                    self.local_conn.close()
+                except Exception:
+                    pass
+                self.local_conn = None
+        if self.local_conn is not None:
+            self.local_conn.close()
+
+    def status(self):
+        return {
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "last_purged": self.last_purged,
+            "rows_purged": self.purged,
+            "seconds": round(self.seconds, 3),
+        }
+
+
+class ConsistencyScan(threading.Thread):
+    def __init__(self, receiver_id=None, source=None):
+        super().__init__()
+        self.receiver_id = receiver_id
+        self.source = source_name(source)
+        self.state = "running"
+        self.phase = "starting"
+        self.started = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.finished = None
+        self.commodities = 0
+        self.checked = 0
+        self.total = 0
+        self.diverged = []
+        self.error = None
+
+    def hashes(self, cur):
+        cur.execute(HISTORY_HASHES_SQL)
+        return {row[0]: (row[1], row[2]) for row in cur}
+
+    def scan(self, local, remote):
+        localcur = local.cursor()
+        remotecur = remote.cursor()
+        # one grouped query per side instead of one per commodity
+        self.phase = "hashing local"
+        local_hashes = self.hashes(localcur)
+        self.phase = "hashing remote"
+        remote_hashes = self.hashes(remotecur)
+        ids = local_hashes.keys() | remote_hashes.keys()
+        self.commodities = len(ids)
+        mismatched = sorted(
+            id for id in ids
+            if local_hashes.get(id) != remote_hashes.get(id)
+        )
+        self.total = len(mismatched)
+        self.phase = "comparing histories"
+        for id in mismatched:
+            if stop_event.is_set():
+                raise RuntimeError("stopped by the service shutdown")
+            result = diff_tovar_history(localcur, remotecur, id)
+            if result["distance"]:
+                self.diverged.append({
+                    "tovar_id": id,
+                    "local_length": result["local_length"],
+                    "remote_length": result["remote_length"],
+                    "distance": result["distance"],
+                })
+            self.checked += 1
+
+    def run(self):
+        local = remote = None
+        try:
+            local = connect_to_database(**source_database(self.source))
+            if local is None:
+                raise ConnectionError("Local database is not available")
+            receiver = get_receiver_dsn(local.cursor(), self.receiver_id)
+            if receiver is None:
+                raise LookupError("receiver not found")
+            remote = connect_to_database(*receiver)
+            if remote is None:
+                raise ConnectionError("remote db not available")
+            self.scan(local, remote)
+            self.state = "finished"
+            logger.info(
+                f"Consistency scan finished, {len(self.diverged)} of "
+                f"{self.commodities} commodities diverged"
+            )
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            logger.error(f"Consistency scan failed, error: {e}")
+        finally:
+            self.phase = "done"
+            self.finished = datetime.datetime.now().strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+            if remote is not None:
+                remote.close()
+            if local is not None:
+                local.close()
+
+    def status(self):
+        return {
+            "status": self.state,
+            "phase": self.phase,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "progress": {
+                "commodities": self.commodities,
+                "mismatched": self.total,
+                "checked": self.checked,
+            },
+            "diverged": list(self.diverged),
+        }
+
+
+class ReceiverProbe(threading.Thread):
+    # daemon threads, so a host that never answers cannot block the exit
+    def __init__(self, dsn, user, password):
+        super().__init__(daemon=True)
+        self.dsn = dsn
+        self.user = user
+        self.password = password
+        self.result = None
+
+    def run(self):
+        self.result = probe_receiver(self.dsn, self.user, self.password)
+
+
+class ReceiverMonitor(threading.Thread):
+    def __init__(self, source=None):
+        super().__init__(daemon=True)
+        self.source = source_name(source)
+        self.configure()
+        self.wakeup = threading.Event()
+        self.probes = {}
+        self.receivers = {}
+        self.stale_count = None
+        self.receiver_count = None
+        self.refreshed = None
+        self.error = None
+
+    def configure(self):
+        settings = config.get("probe", {})
+        self.connect_timeout = settings.get("connect_timeout", 5)
+        self.cache_ttl = settings.get("cache_ttl", 30)
+        self.refresh_interval = settings.get("refresh_interval", 15)
+
+    def refresh(self):
+        with local_pool(self.source).connection() as local:
+            if local is None:
+                self.error = "Local database is not available"
+                return
+            cur = local.cursor()
+            cur.execute("select count(*) from rpl_log")
+            self.stale_count = cur.fetchone()[0]
+            sql = "SELECT alias, dbname, dbuser, dbpass FROM rpl_databases"
+            cur.execute(sql)
+            rows = cur.fetchall()
+        self.error = None
+        self.receiver_count = len(rows)
+        for alias, dsn, user, password in rows:
+            # a probe hanging on a dead host is not started over again
+            probe = self.probes.get(alias)
+            if probe is None or not probe.is_alive():
+                probe = ReceiverProbe(dsn, user, password)
+                self.probes[alias] = probe
+                probe.start()
+        deadline = time.monotonic() + self.connect_timeout
+        for row in rows:
+            self.probes[row[0]].join(max(0, deadline - time.monotonic()))
+        checked_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        receivers = {}
+        for row in rows:
+            alias = row[0]
+            probe = self.probes[alias]
+            previous = self.receivers.get(alias, {})
+            if probe.is_alive():
+                result = {"available": False, "error": "connect timeout"}
+            else:
+                result = probe.result
+            entry = {
+                "status": (
+                    "Available" if result["available"] else "Not available"
+                ),
+                "latency_ms": result.get("latency_ms"),
+                "last_seen": previous.get("last_seen"),
+                "checked_at": checked_at,
+            }
+            if result["available"]:
+                entry["last_seen"] = checked_at
+            else:
+                entry["error"] = result["error"]
+            receivers[alias] = entry
+        for alias in list(self.probes):
+            if alias not in receivers:
+                del self.probes[alias]
+        self.receivers = receivers
+        self.refreshed = time.monotonic()
+
+    def run(self):
+        while not stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                self.error = str(e)
+                logger.error(f"Failed to probe receivers, error: {e}")
+            self.wakeup.wait(self.refresh_interval)
+            self.wakeup.clear()
+
+    def status(self):
+        age = None
+        if self.refreshed is not None:
+            age = round(time.monotonic() - self.refreshed, 1)
+        if age is None or age > self.cache_ttl:
+            self.wakeup.set()
+        return {
+            "status": "ok" if self.error is None else self.error,
+            "stale_count": self.stale_count,
+            "receiver_count": self.receiver_count,
+            "receivers": self.receivers,
+            "age": age,
+        }
+
+
+def load_rpl_tables(con):
+    # {table name: (rpl_allfields, is_docheader)}
+    cur = con.cursor()
+    cur.execute(
+        "select table_name, rpl_allfields, is_docheader from rpl_tables"
+    )
+    tables = {
+        name.strip().lower(): (bool(allfields), bool(docheader))
+        for name, allfields, docheader in cur.fetchall()
+    }
+    con.rollback()
+    return tables
+
+
+def open_receiver(dsn, user, password, timeout=60):
+    # changes written through this connection are not logged for replication
+    con = connect_to_database(dsn, user, password, timeout=timeout)
+    if con is None:
+        return None
+    cur = con.cursor()
+    sql = (
+        "select rdb$set_context('USER_SESSION', "
+        "'replicating_now', 1) from rdb$database"
+    )
+    cur.execute(sql)
+    con.commit()
+    return con
 
 
-def connect_to_database(dsn, user, password, timeout=60):
+CHECKPOINT_DDL = (
+    "create table rpl_checkpoint ("
+    "source varchar(63) not null, slot integer not null, "
+    "last_id bigint not null, updated_at timestamp, "
+    "primary key (source, slot))"
+)
+
+
+def read_checkpoints(con, source):
+    # {slot: last_id} of the source on the receiver, the table is created
+    # on first use
+    cur = con.cursor()
+    sql = "select slot, last_id from rpl_checkpoint where source = ?"
+    try:
+        cur.execute(sql, [source])
+        slots = dict(cur.fetchall())
+        con.commit()
+    except get_backend().DatabaseError:
+        con.rollback()
+        logger.info("Creating rpl_checkpoint on the receiver")
+        cur.execute(CHECKPOINT_DDL)
+        con.commit()
+        slots = {}
+    return slots
+
+
+def write_checkpoint(cursor, source, last_id, slot=0):
+    sql = (
+        "update or insert into rpl_checkpoint "
+        "(source, slot, last_id, updated_at) "
+        "values (?, ?, ?, current_timestamp) matching (source, slot)"
+    )
+    cursor.execute(sql, [source, slot, last_id])
+
+
+def reset_checkpoint(con, source, last_id):
+    read_checkpoints(con, source)
+    cur = con.cursor()
+    sql = "delete from rpl_checkpoint where source = ?"
+    cur.execute(sql, [source])
+    write_checkpoint(cur, source, last_id)
+    con.commit()
+
+
+def open_spool(receiver_id, source=None):
+    settings = config.get("spool", {})
+    if not settings.get("directory"):
+        return None
+    directory = source_directory(settings["directory"], source)
+    return Spool(
+        os.path.join(directory, str(receiver_id)),
+        max_size=settings.get("max_size_mb", 1024) << 20,
+        segment_size=settings.get("segment_size_mb", 64) << 20,
+    )
+
+
+def open_connection(dsn, user, password):
+    return get_backend().connect(dsn, user, password)
+
+
+def connect_to_database(dsn, user, password, timeout=60, retry_interval=10):
     global stop_event
     start_time = time.time()
     while not stop_event.is_set():
         try:
-            if time.time() - start_time > timeout:
-                logger.info(
-                    f"Timeout of {timeout} seconds reached while "
-                    f"trying to connect to {dsn}"
-                )
-                return None
             logger.info(f"Trying to connect to {dsn}")
-            con = fdb.connect(
-                dsn=dsn, user=user, password=password, charset="UTF8"
-            )
+            con = open_connection(dsn, user, password)
             logger.info(f"Successfully connected to {dsn}")
             return con
-        except fdb.fbcore.DatabaseError as e:
+        except get_backend().DatabaseError as e:
             logger.error(f"Failed to connect to {dsn}, error: {e}")
-            time.sleep(10)
+        if time.time() - start_time + retry_interval > timeout:
+            logger.info(
+                f"Timeout of {timeout} seconds reached while "
+                f"trying to connect to {dsn}"
+            )
+            return None
+        stop_event.wait(retry_interval)
     logger.info(f"Stopped trying to connect to {dsn} due to stop event")
     return None
 
 
-def listener_thread():
-    global _listener_thread
-    if _listener_thread is None:
-        _listener_thread = ListeningThread(["replicate"])
-        _listener_thread.start()
-    return _listener_thread
+def probe_receiver(dsn, user, password):
+    started = time.monotonic()
+    try:
+        con = open_connection(dsn, user, password)
+        try:
+            cur = con.cursor()
+            cur.execute("select 1 from rdb$database")
+            cur.fetchone()
+        finally:
+            con.close()
+    except Exception as e:
+        logger.debug(f"Receiver {dsn} is not available, error: {e}")
+        return {"available": False, "error": str(e)}
+    latency = round((time.monotonic() - started) * 1000, 1)
+    return {"available": True, "latency_ms": latency}
+
+
+def sources():
+    # {name: connection settings} of the master databases, `database` is
+    # the only one unless a list of sources is configured
+    configured = config.get("sources")
+    if not configured:
+        name = config.get("replication", {}).get("source", "master")
+        return {name: config["database"]}
+    return {
+        source["name"]: {
+            key: source[key] for key in ("dsn", "user", "password")
+        }
+        for source in configured
+    }
+
+
+class UnknownSource(LookupError):
+    pass
+
+
+def source_name(source=None):
+    names = list(sources())
+    if source is None:
+        return names[0]
+    if source not in names:
+        raise UnknownSource(f"source {source} not found")
+    return source
+
+
+def source_database(source=None):
+    return sources()[source_name(source)]
+
+
+def source_directory(directory, source=None):
+    # with several sources each keeps its files in a subdirectory
+    if not config.get("sources"):
+        return directory
+    return os.path.join(directory, source_name(source))
+
+
+def receiver_label(source, alias):
+    if not config.get("sources"):
+        return alias
+    return f"{source}/{alias}"
+
+
+def listener_thread(source=None):
+    source = source_name(source)
+    with lock:
+        if source not in _listeners:
+            tracing.configure()
+            _listeners[source] = ListeningThread(["replicate"], source)
+            _listeners[source].start()
+    return _listeners[source]
 
 
-def stop_event_processing():
+def listener_threads():
+    return [listener_thread(source) for source in sources()]
+
+
+def receiver_monitor(source=None):
+    source = source_name(source)
+    with lock:
+        if source not in _receiver_monitors:
+            _receiver_monitors[source] = ReceiverMonitor(source)
+            _receiver_monitors[source].start()
+    return _receiver_monitors[source]
+
+
+def receiver_monitors():
+    return [receiver_monitor(source) for source in sources()]
+
+
+def local_pool(source=None):
+    source = source_name(source)
+    with lock:
+        if source not in _local_pools:
+            settings = config.get("pool", {})
+            database = source_database(source)
+            _local_pools[source] = ConnectionPool(
+                lambda: connect_to_database(**database),
+                max_size=settings.get("max_size", 5),
+                idle_timeout=settings.get("idle_timeout", 300),
+                check_after=settings.get("check_after", 30),
+                wait_timeout=settings.get("wait_timeout", 30),
+            )
+    return _local_pools[source]
+
+
+def rpl_log_head(max_age=1, source=None):
+    # backlog and lag are scraped together, so one query serves both; a
+    # scrape must not wait for the master, failures are kept as long and
+    # a connection is tried once
+    source = source_name(source)
+    checked, head = _rpl_log_heads.get(source, (0, None))
+    if time.monotonic() - checked < max_age:
+        return head
+    _rpl_log_heads[source] = (time.monotonic(), None)
+    database = source_database(source)
+    pool = local_pool(source)
+    try:
+        with pool.connection(
+            wait_timeout=0,
+            connect=lambda: connect_to_database(**database, timeout=0),
+        ) as local:
+            if local is None:
+                return None
+            cur = local.cursor()
+            cur.execute("select max(id) from rpl_log")
+            head = cur.fetchone()[0] or 0
+    except get_backend().Error as e:
+        logger.debug("Failed to read the rpl_log head: %s", e)
+        return None
+    _rpl_log_heads[source] = (time.monotonic(), head)
+    return head
+
+
+def listener_workers(source=None):
+    # workers of one source, or of all of them
+    if source is None:
+        listeners = list(_listeners.values())
+    else:
+        listeners = [_listeners.get(source_name(source))]
+    return [
+        worker for listener in listeners if listener is not None
+        for worker in list(listener.workers.values())
+    ]
+
+
+def replication_status(source=None):
+    if source is not None or len(sources()) == 1:
+        listener = _listeners.get(source_name(source))
+        return listener.status() if listener else {"status": "stopped"}
+    statuses = {
+        name: listener.status() for name, listener in _listeners.items()
+    }
+    processing = any(
+        status["status"] == "processing" for status in statuses.values()
+    )
+    return {
+        "status": "processing" if processing else "listening",
+        "sources": statuses,
+    }
+
+
+def receiver_backlog():
+    backlog = {}
+    for worker in listener_workers():
+        head = rpl_log_head(source=worker.source)
+        if head is not None:
+            backlog[(worker.label,)] = max(0, head - (worker.last_id or 0))
+    return backlog
+
+
+def receiver_lag():
+    # seconds since the oldest change the receiver was notified about
+    now = time.time()
+    backlog = receiver_backlog()
+    lag = {}
+    for worker in listener_workers():
+        behind_since = worker.behind_since
+        if backlog.get((worker.label,)) and behind_since is not None:
+            lag[(worker.label,)] = round(now - behind_since, 3)
+        else:
+            lag[(worker.label,)] = 0
+    return lag
+
+
+metrics.GaugeCallback(
+    "abasyn_backlog_rows", "rpl_log rows not yet applied on the receiver",
+    ("receiver",), receiver_backlog,
+)
+metrics.GaugeCallback(
+    "abasyn_lag_seconds", "Replication lag of the receiver",
+    ("receiver",), receiver_lag,
+)
+
+
+def drain_seconds():
+    return config.get("shutdown", {}).get("drain_seconds", 10)
+
+
+def drain_remaining():
+    if _drain_deadline is None:
+        return drain_seconds()
+    return max(0, _drain_deadline - time.monotonic())
+
+
+def handoff_path(source):
+    # None without a configured directory, nothing is handed over then
+    directory = config.get("shutdown", {}).get("handoff_directory")
+    if not directory:
+        return None
+    return os.path.join(directory, f"{source}.json")
+
+
+def save_handoff(source, workers):
+    # what a restart needs to pick up where this process stopped
+    path = handoff_path(source)
+    if path is None:
+        return
+    state = {
+        "saved": time.time(),
+        "receivers": {
+            str(worker.receiver_id): worker.handoff() for worker in workers
+        },
+    }
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f, indent=1)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.error(f"Failed to save the handoff state to {path}: {e}")
+
+
+def load_handoff(source):
+    # read once per process, ignored when older than handoff_max_age
+    if source not in _handoffs:
+        max_age = config.get("shutdown", {}).get("handoff_max_age", 3600)
+        path = handoff_path(source)
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (TypeError, OSError, ValueError):
+            state = None
+        if state is None or time.time() - state["saved"] > max_age:
+            _handoffs[source] = {}
+        else:
+            _handoffs[source] = state["receivers"]
+    return _handoffs[source]
+
+
+def reload_settings():
+    tracing.configure()
+    for source in sources():
+        if source not in _listeners:
+            logger.warning(f"Source {source} takes effect after a restart")
+    for listener in list(_listeners.values()):
+        listener.reload()
+    for monitor in list(_receiver_monitors.values()):
+        monitor.configure()
+        monitor.wakeup.set()
+
+
+def stop_event_processing(drain=None):
+    # workers get drain seconds to finish the batch at hand
+    global _drain_deadline
+    if drain is None:
+        drain = drain_seconds()
+    _drain_deadline = time.monotonic() + drain
     stop_event.set()
+    for listener in list(_listeners.values()):
+        listener.wake()
+        for helper in (listener.poller, listener.janitor):
+            if helper is not None:
+                helper.wakeup.set()
+    for monitor in list(_receiver_monitors.values()):
+        monitor.wakeup.set()
+    for pool in list(_local_pools.values()):
+        pool.close()
 
 
 def levenshtein_distance_operations(list1, list2):
-    len_list1 = len(list1) + 1
-    len_list2 = len(list2) + 1
-    # Create a matrix to store distances and operations
-    matrix = [[0 for n in range(len_list2)] for m in range(len_list1)]
-    operations = [[[] for n in range(len_list2)] for m in range(len_list1)]
-    # Initialize the first row and column of the matrix
-    for i in range(len_list1):
-        matrix[i][0] = i
-        if i > 0:
-            operations[i][0] = operations[i - 1][0] + [
-                ("delete", list1[i - 1], i - 1)
-            ]
-    for j in range(len_list2):
-        matrix[0][j] = j
-        if j > 0:
-            operations[0][j] = operations[0][j - 1] + [
-                ("insert", list2[j - 1], j - 1)
-            ]
-    # Compute the Levenshtein distance and operations
-    for i in range(1, len_list1):
-        for j in range(1, len_list2):
-            if list1[i - 1] == list2[j - 1]:
-                cost = 0
-                operation = []
-            else:
-                cost = 1
-                operation = [
-                    ("substitute", list1[i - 1], list2[j - 1], i - 1, j - 1)
-                ]
-
-            deletion_cost = matrix[i - 1][j] + 1
-            insertion_cost = matrix[i][j - 1] + 1
-            substitution_cost = matrix[i - 1][j - 1] + cost
-
-            min_cost = min(deletion_cost, insertion_cost, substitution_cost)
-            matrix[i][j] = min_cost
-
-            if min_cost == deletion_cost:
-                operations[i][j] = operations[i - 1][j] + [
-                    ("delete", list1[i - 1], i - 1)
-                ]
-            elif min_cost == insertion_cost:
-                operations[i][j] = operations[i][j - 1] + [
-                    ("insert", list2[j - 1], j - 1)
-                ]
-            else:
-                operations[i][j] = operations[i - 1][j - 1] + operation
+    return diff_operations(list1, list2)
 
-    return matrix[-1][-1], operations[-1][-1]
 
-
-def check_tovar_history(id):
-    local = connect_to_database(**config["database"])
-    if local is None:
-        return {"status": "Local database is not available"}
-    cur = local.cursor()
-    cur.execute("SELECT dbname, dbuser, dbpass FROM rpl_databases")
-    dsn, user, password = cur.fetchone()
-    sql = (
-        "select tovar_id, tovar_code, cast(date_op as char(10)), amount,"
-        "pos_id, doc_id, doc_type, snd_storage, rcv_storage "
-        "from m_tovar where tovar_id = ?"
-        "order by date_op, id"
+HISTORY_FIELDS = (
+    "tovar_id", "tovar_code", "cast(date_op as char(10))", "amount",
+    "pos_id", "doc_id", "doc_type", "snd_storage", "rcv_storage",
+)
+HISTORY_SQL = (
+    f"select {', '.join(HISTORY_FIELDS)} "
+    "from m_tovar where tovar_id = ? "
+    "order by date_op, id"
+)
+# Order independent per commodity fingerprint, computed on the server side
+ROW_HASH = "bin_and(hash({}), 4294967295)".format(
+    " || '|' || ".join(
+        f"coalesce(cast({field} as varchar(64)), '')"
+        for field in HISTORY_FIELDS[1:]
     )
-    cur.execute(sql, [id])
-    local_result = cur.fetchall()
-    local.close()
-    remote = connect_to_database(dsn, user, password)
-    if remote is None:
-        return {"status": "remote db not available"}
-    cur = remote.cursor()
-    cur.execute(sql, [id])
-    remote_result = cur.fetchall()
-    remote.close()
+)
+HISTORY_HASHES_SQL = (
+    f"select tovar_id, count(*), sum({ROW_HASH}) "
+    "from m_tovar group by tovar_id"
+)
+HISTORY_FINGERPRINT_SQL = (
+    f"select count(*), max(id), sum({ROW_HASH}) "
+    "from m_tovar where tovar_id = ?"
+)
+HISTORY_PREFIX_SQL = (
+    f"select count(*), sum({ROW_HASH}) "
+    "from m_tovar where tovar_id = ? and id <= ?"
+)
+HISTORY_TAIL_SQL = (
+    f"select {', '.join(HISTORY_FIELDS)} "
+    "from m_tovar where tovar_id = ? and id > ? "
+    "order by date_op, id"
+)
+
+
+def get_receiver_dsn(cur, receiver_id=None):
+    if receiver_id is None:
+        cur.execute("SELECT dbname, dbuser, dbpass FROM rpl_databases")
+    else:
+        sql = "SELECT dbname, dbuser, dbpass FROM rpl_databases WHERE id = ?"
+        cur.execute(sql, [receiver_id])
+    return cur.fetchone()
+
+
+def diff_tovar_history(localcur, remotecur, id):
+    localcur.execute(HISTORY_SQL, [id])
+    local_result = localcur.fetchall()
+    remotecur.execute(HISTORY_SQL, [id])
+    remote_result = remotecur.fetchall()
     distance, operations = levenshtein_distance_operations(
         local_result, remote_result
     )
     return {
-        "status": "ok",
         "local_length": len(local_result),
         "remote_length": len(remote_result),
         "distance": distance,
@@ -286,146 +1588,229 @@ def check_tovar_history(id):
     }
 
 
-def check_replication_status():
-    local = connect_to_database(**config["database"])
-    if local is None:
-        return {"status": "Local database is not available"}
-    cur = local.cursor()
-    cur.execute("SELECT count(*) FROM rpl_databases")
-    client_count = cur.fetchone()[0]
-    sql = "select count(*) from rpl_log"
-    cur.execute(sql)
-    records_count = cur.fetchone()[0]
-    sql = "SELECT alias, dbname, dbuser, dbpass FROM rpl_databases"
-    cur.execute(sql)
-    local_result = cur.fetchall()
-    clients = {}
-    for row in local_result:
-        alias, dsn, user, password = row
-        remote = connect_to_database(dsn, user, password)
-        if remote is None:
-            clients[alias] = "Not available"
-        else:
-            clients[alias] = "Available"
-        remote.close()
-    local.close()
-    return {
-        "status": "ok",
-        "stale_count": records_count,
-        "receiver_count": client_count,
-        "receivers": clients,
+def history_cache():
+    global _history_cache
+    if _history_cache is None:
+        with lock:
+            if _history_cache is None:
+                settings = config.get("check_cache", {})
+                _history_cache = SizedCache(
+                    settings.get("max_size_mb", 64) << 20
+                )
+    return _history_cache
+
+
+def fetch_history(cur, id, cached, fingerprint):
+    # (rows, how): a cached side is reused when it is unchanged, or fetched
+    # from its last id on when rows were only appended after it
+    if cached is not None:
+        rows, previous = cached
+        if previous == fingerprint:
+            return rows, "hit"
+        count, max_id, total = previous
+        if max_id is not None and fingerprint[0] > count:
+            cur.execute(HISTORY_PREFIX_SQL, [id, max_id])
+            if tuple(cur.fetchone()) == (count, total):
+                cur.execute(HISTORY_TAIL_SQL, [id, max_id])
+                tail = cur.fetchall()
+                # a back dated row would not sort after the cached ones
+                if (tail[0][2] or "") >= (rows[-1][2] or ""):
+                    return rows + tail, "tail"
+    cur.execute(HISTORY_SQL, [id])
+    return cur.fetchall(), "full"
+
+
+def cached_history_diff(localcur, remotecur, id, key):
+    cache = history_cache()
+    entry = cache.get(key)
+    localcur.execute(HISTORY_FINGERPRINT_SQL, [id])
+    local_fingerprint = tuple(localcur.fetchone())
+    remotecur.execute(HISTORY_FINGERPRINT_SQL, [id])
+    remote_fingerprint = tuple(remotecur.fetchone())
+    if entry is not None and (
+        entry["local"][1] == local_fingerprint
+        and entry["remote"][1] == remote_fingerprint
+    ):
+        return dict(entry["result"], cache="hit")
+    local_rows, local_how = fetch_history(
+        localcur, id, entry and entry["local"], local_fingerprint
+    )
+    remote_rows, remote_how = fetch_history(
+        remotecur, id, entry and entry["remote"], remote_fingerprint
+    )
+    # both sides only grew, the common prefix found last time still holds
+    start = 0
+    if entry is not None and "full" not in (local_how, remote_how):
+        start = entry["common"]
+    distance, operations = diff_operations(
+        local_rows, remote_rows, start=start
+    )
+    result = {
+        "local_length": len(local_rows),
+        "remote_length": len(remote_rows),
+        "distance": distance,
+        "operations": operations,
     }
+    size = len(repr(local_rows)) + len(repr(remote_rows)) + \
+        len(repr(operations))
+    cache.put(key, {
+        "local": (local_rows, local_fingerprint),
+        "remote": (remote_rows, remote_fingerprint),
+        "common": common_prefix(
+            operations, len(local_rows), len(remote_rows)
+        ),
+        "result": result,
+    }, size)
+    return dict(result, cache="tail" if start else "miss")
 
 
-def init_replication():
-    local = connect_to_database(**config["database"])
-    if local is None:
-        return {"status": "error",
-                "message": "Local database is not available"}
-    cur = local.cursor()
-    sql = "SELECT count(*) from RPL_TABLES"
-    cur.execute(sql)
-    table_count = cur.fetchone()[0]
-    if table_count > 0:
-        local.close()
-        return {"status": "warning",
-                "message": "Replication is already initialized"}
-    init_data = (
-        ('cr_group_tags', 0),
-        ('cr_tovar_tags', 0),
-        ('c_docum', 0),
-        ('c_eanserial', 0),
-        ('c_grouptovar', 0),
-        ('inc_delivery', 1),
-        ('inc_order', 1),
-        ('inc_price', 0),
-        ('inc_return', 1),
-        ('int_move', 1),
-        ('int_off', 1),
-        ('int_revision', 1),
-        ('m_money', 0),
-        ('out_bill', 1),
-        ('out_check', 1),
-        ('out_delivery', 1),
-        ('out_order', 1),
-        ('out_return', 1),
-        ('r_banks', 0),
-        ('r_cachedesks', 0),
-        ('r_contragents', 0),
-        ('r_contragents_subtypes', 0),
-        ('r_currencies', 0),
-        ('r_currency_courses', 0),
-        ('r_groups', 0),
-        ('r_prices', 0),
-        ('r_storages', 0),
-        ('r_tovar', 0),
-        ('r_workers', 0),
-        ('s_cash', 0),
-        ('s_discounts', 0),
-        ('s_netmarket', 0),
-        ('s_selections', 0),
-        ('s_tovarcredyt', 0),
-        ('tag_names', 0),
-        ('tag_values', 0)
-        )
-    sql = ("INSERT into RPL_TABLES(TABLE_NAME, RPL_ALLFIELDS, IS_DOCHEADER)"
-           " VALUES(?, 1, ?)")
-    for row in init_data:
-        cur.execute(sql, row)
-    local.commit()
-    sql = "EXECUTE PROCEDURE RPL_INSTALL"
-    cur.execute(sql)
-    local.commit()
-    local.close()
+def check_tovar_history(id, receiver_id=None, source=None):
+    source = source_name(source)
+    with local_pool(source).connection() as local:
+        if local is None:
+            return {"status": "Local database is not available"}
+        cur = local.cursor()
+        receiver = get_receiver_dsn(cur, receiver_id)
+        if receiver is None:
+            return {"status": "receiver not found"}
+        remote = connect_to_database(*receiver)
+        if remote is None:
+            return {"status": "remote db not available"}
+        try:
+            result = cached_history_diff(
+                cur, remote.cursor(), id, (source, receiver[0], str(id))
+            )
+        finally:
+            remote.close()
+    return dict(status="ok", **result)
+
+
+def start_consistency_scan(receiver_id=None, source=None):
+    source = source_name(source)
+    with lock:
+        scan = _consistency_scans.get(source)
+        if scan is None or not scan.is_alive():
+            scan = _consistency_scans[source] = ConsistencyScan(
+                receiver_id, source
+            )
+            scan.start()
+    return scan.status()
+
+
+def consistency_scan_status(source=None):
+    scan = _consistency_scans.get(source_name(source))
+    if scan is None:
+        return {"status": "not started"}
+    return scan.status()
+
+
+def check_replication_status(source=None):
+    return receiver_monitor(source).status()
+
+
+def init_replication(source=None):
+    with local_pool(source).connection() as local:
+        if local is None:
+            return {"status": "error",
+                    "message": "Local database is not available"}
+        cur = local.cursor()
+        sql = "SELECT count(*) from RPL_TABLES"
+        cur.execute(sql)
+        table_count = cur.fetchone()[0]
+        if table_count > 0:
+            return {"status": "warning",
+                    "message": "Replication is already initialized"}
+        init_data = (
+            ('cr_group_tags', 0),
+            ('cr_tovar_tags', 0),
+            ('c_docum', 0),
+            ('c_eanserial', 0),
+            ('c_grouptovar', 0),
+            ('inc_delivery', 1),
+            ('inc_order', 1),
+            ('inc_price', 0),
+            ('inc_return', 1),
+            ('int_move', 1),
+            ('int_off', 1),
+            ('int_revision', 1),
+            ('m_money', 0),
+            ('out_bill', 1),
+            ('out_check', 1),
+            ('out_delivery', 1),
+            ('out_order', 1),
+            ('out_return', 1),
+            ('r_banks', 0),
+            ('r_cachedesks', 0),
+            ('r_contragents', 0),
+            ('r_contragents_subtypes', 0),
+            ('r_currencies', 0),
+            ('r_currency_courses', 0),
+            ('r_groups', 0),
+            ('r_prices', 0),
+            ('r_storages', 0),
+            ('r_tovar', 0),
+            ('r_workers', 0),
+            ('s_cash', 0),
+            ('s_discounts', 0),
+            ('s_netmarket', 0),
+            ('s_selections', 0),
+            ('s_tovarcredyt', 0),
+            ('tag_names', 0),
+            ('tag_values', 0)
+            )
+        sql = ("INSERT into RPL_TABLES(TABLE_NAME, RPL_ALLFIELDS, "
+               "IS_DOCHEADER) VALUES(?, 1, ?)")
+        for row in init_data:
+            cur.execute(sql, row)
+        local.commit()
+        sql = "EXECUTE PROCEDURE RPL_INSTALL"
+        cur.execute(sql)
+        local.commit()
     return {"status": "ok", "message": "Replication initialized successfully"}
 
 
-def get_receivers():
-    local = connect_to_database(**config["database"])
-    if local is None:
-        return {"status": "Local database is not available"}
-    cur = local.cursor()
-    sql = "SELECT id, alias, dbname FROM rpl_databases"
-    cur.execute(sql)
-    local_result = cur.fetchall()
-    local.close()
-    return {"status": "ok", "receivers": local_result}
-
-
-def get_receiver(id):
-    local = connect_to_database(**config["database"])
-    if local is None:
-        return {"status": "Local database is not available"}
-    cur = local.cursor()
-    sql = ("SELECT id, alias, dbname, dbuser, dbpass FROM rpl_databases"
-           " WHERE id = ?")
-    cur.execute(sql, [id])
-    local_result = cur.fetchone()
-    local.close()
-    return {"status": "ok", "receiver": local_result}
-
-
-def add_receiver(alias, dbname, dbuser, dbpass):
-    local = connect_to_database(**config["database"])
-    if local is None:
-        return {"status": "Local database is not available"}
-    cur = local.cursor()
-    sql = ("INSERT INTO rpl_databases (alias, dbname, dbuser, dbpass)"
-           " VALUES (?, ?, ?, ?) returning ID")
-    cur.execute(sql, [alias, dbname, dbuser, dbpass])
-    id = cur.fetchone()[0]
-    local.commit()
-    local.close()
-    return {"status": "ok", "id": id}
-
-
-def del_receiver(id):
-    local = connect_to_database(**config["database"])
-    if local is None:
-        return {"status": "Local database is not available"}
-    cur = local.cursor()
-    sql = "DELETE FROM rpl_databases WHERE id = ?"
-    cur.execute(sql, [id])
-    local.commit()
-    local.close()
-    return {"status": "ok"}
+def get_receivers(source=None):
+    with local_pool(source).connection() as local:
+        if local is None:
+            return {"status": "Local database is not available"}
+        cur = local.cursor()
+        sql = "SELECT id, alias, dbname FROM rpl_databases"
+        cur.execute(sql)
+        local_result = cur.fetchall()
+        return {"status": "ok", "receivers": local_result}
+
+
+def get_receiver(id, source=None):
+    with local_pool(source).connection() as local:
+        if local is None:
+            return {"status": "Local database is not available"}
+        cur = local.cursor()
+        sql = ("SELECT id, alias, dbname, dbuser, dbpass FROM rpl_databases"
+               " WHERE id = ?")
+        cur.execute(sql, [id])
+        local_result = cur.fetchone()
+        return {"status": "ok", "receiver": local_result}
+
+
+def add_receiver(alias, dbname, dbuser, dbpass, source=None):
+    with local_pool(source).connection() as local:
+        if local is None:
+            return {"status": "Local database is not available"}
+        cur = local.cursor()
+        sql = ("INSERT INTO rpl_databases (alias, dbname, dbuser, dbpass)"
+               " VALUES (?, ?, ?, ?) returning ID")
+        cur.execute(sql, [alias, dbname, dbuser, dbpass])
+        id = cur.fetchone()[0]
+        local.commit()
+        return {"status": "ok", "id": id}
+
+
+def del_receiver(id, source=None):
+    with local_pool(source).connection() as local:
+        if local is None:
+            return {"status": "Local database is not available"}
+        cur = local.cursor()
+        sql = "DELETE FROM rpl_databases WHERE id = ?"
+        cur.execute(sql, [id])
+        local.commit()
+        return {"status": "ok"}
@@ -0,0 +1,334 @@
+import time
+
+# Minimal Levenshtein scripts (unit cost delete, insert and substitute) in
+# O((N + M) D) time with the diagonal search of Ukkonen and Landau-Vishkin:
+# for every distance d the furthest row reached on each diagonal is kept,
+# so the work and the memory for the traceback grow with the distance, not
+# with the length of the histories. Rows are interned to small integers
+# first, so the inner loops only compare ints. Histories further apart than
+# MAX_DISTANCE, or a search running out of time, are cut at rows occurring
+# once on both sides and in the same order (as in patience diff) and the
+# pieces searched separately, which is fast but may miss the minimum;
+# pieces still too far apart go to the linear space Myers algorithm.
+
+MAX_DISTANCE = 2000
+
+
+def _intern(list1, list2):
+    keys = {}
+    a = [keys.setdefault(row, len(keys)) for row in list1]
+    b = [keys.setdefault(row, len(keys)) for row in list2]
+    return a, b
+
+
+def _bisect(a, alo, ahi, b, blo, bhi, deadline):
+    # Find the middle snake of the range, returns the split point or None
+    # if the ranges should be treated as a single replaced block.
+    n = ahi - alo
+    m = bhi - blo
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    length = 2 * max_d + 2
+    v1 = [-1] * length
+    v2 = [-1] * length
+    v1[offset + 1] = 0
+    v2[offset + 1] = 0
+    delta = n - m
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+    for d in range(max_d):
+        if deadline is not None and time.monotonic() > deadline:
+            return None
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (
+                k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]
+            ):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < length and v2[k2_offset] != -1:
+                    if x1 >= n - v2[k2_offset]:
+                        return alo + x1, blo + y1
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (
+                k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]
+            ):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while (
+                x2 < n
+                and y2 < m
+                and a[ahi - x2 - 1] == b[bhi - y2 - 1]
+            ):
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = offset + x1 - k1_offset
+                    if x1 >= n - x2:
+                        return alo + x1, blo + y1
+    return None
+
+
+def _gaps(a, b, deadline):
+    # Yield (alo, ahi, blo, bhi) ranges which differ, in order
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        # common prefix and suffix never need the full search
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if alo == ahi and blo == bhi:
+            continue
+        if alo == ahi or blo == bhi:
+            yield alo, ahi, blo, bhi
+            continue
+        if set(a[alo:ahi]).isdisjoint(b[blo:bhi]):
+            yield alo, ahi, blo, bhi
+            continue
+        split = _bisect(a, alo, ahi, b, blo, bhi, deadline)
+        if split is None:
+            yield alo, ahi, blo, bhi
+            continue
+        x, y = split
+        stack.append((x, ahi, y, bhi))
+        stack.append((alo, x, blo, y))
+
+
+def _levenshtein(a, b, deadline):
+    # furthest row per diagonal k = j - i for each distance, or None
+    n = len(a)
+    m = len(b)
+    x = 0
+    while x < n and x < m and a[x] == b[x]:
+        x += 1
+    fronts = [[x]]
+    target = m - n
+    d = 0
+    while abs(target) > d or fronts[d][target + d] < n:
+        d += 1
+        if d > MAX_DISTANCE or (
+            deadline is not None and time.monotonic() > deadline
+        ):
+            return None
+        previous = fronts[-1]
+        front = [-1] * (2 * d + 1)
+        for k in range(max(-d, -n), min(d, m) + 1):
+            x = -1
+            if -d < k < d:
+                p = previous[k + d - 1]
+                if 0 <= p < n and p + k < m:
+                    # substitute
+                    x = p + 1
+            if k < d - 1:
+                p = previous[k + d]
+                if 0 <= p < n and p + 1 > x:
+                    # delete
+                    x = p + 1
+            if k > 1 - d:
+                p = previous[k + d - 2]
+                if p >= 0 and p + k <= m and p > x:
+                    # insert
+                    x = p
+            if x < 0:
+                continue
+            while x < n and x + k < m and a[x] == b[x + k]:
+                x += 1
+            front[k + d] = x
+        fronts.append(front)
+    return fronts
+
+
+def _trace(list1, list2, n, m, fronts, alo, blo, operations):
+    # walk the fronts back from the end, operations come out reversed
+    script = []
+    k = m - n
+    for d in range(len(fronts) - 1, 0, -1):
+        previous = fronts[d - 1]
+        x = -1
+        step = None
+        if -d < k < d:
+            p = previous[k + d - 1]
+            if 0 <= p < n and p + k < m:
+                x, step = p + 1, 0
+        if k < d - 1:
+            p = previous[k + d]
+            if 0 <= p < n and p + 1 > x:
+                x, step = p + 1, 1
+        if k > 1 - d:
+            p = previous[k + d - 2]
+            if p >= 0 and p + k <= m and p > x:
+                x, step = p, -1
+        i = alo + x
+        j = blo + x + k
+        if step == 0:
+            script.append(
+                ("substitute", list1[i - 1], list2[j - 1], i - 1, j - 1)
+            )
+        elif step == 1:
+            script.append(("delete", list1[i - 1], i - 1))
+        else:
+            script.append(("insert", list2[j - 1], j - 1))
+        k += step
+    script.reverse()
+    operations.extend(script)
+
+
+# Operations keep the shape of the original Levenshtein implementation:
+# ("delete", row, i), ("insert", row, j), ("substitute", row1, row2, i, j).
+# The distance is the number of operations; it is minimal unless the
+# search ran past MAX_DISTANCE or longer than half of timeout seconds. The
+# Myers search then gets the other half, and only the differences it has
+# not narrowed down by then are reported as replaced blocks, which is a
+# valid if not minimal script. start is the length of a prefix already
+# known to be equal on both sides.
+def diff_operations(list1, list2, timeout=2.0, start=0):
+    if start:
+        distance, operations = diff_operations(
+            list1[start:], list2[start:], timeout
+        )
+        return distance, [_shift(op, start) for op in operations]
+    a, b = _intern(list1, list2)
+    deadline = None if timeout is None else time.monotonic() + timeout / 2
+    operations = []
+    # an equal prefix and suffix do not change the distance
+    lo = 0
+    while lo < len(a) and lo < len(b) and a[lo] == b[lo]:
+        lo += 1
+    ahi = len(a)
+    bhi = len(b)
+    while ahi > lo and bhi > lo and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+    fronts = _levenshtein(a[lo:ahi], b[lo:bhi], deadline)
+    if fronts is not None:
+        _trace(list1, list2, ahi - lo, bhi - lo, fronts, lo, lo, operations)
+        return len(operations), operations
+    # the pieces between anchors get the other half of the time
+    if timeout is not None:
+        deadline = time.monotonic() + timeout / 2
+    pieces = []
+    previous = (lo - 1, lo - 1)
+    for anchor in _anchors(a, b, lo, ahi, lo, bhi) + [(ahi, bhi)]:
+        pieces.append((previous[0] + 1, anchor[0], previous[1] + 1, anchor[1]))
+        previous = anchor
+    for alo, ahi, blo, bhi in pieces:
+        fronts = None
+        if len(pieces) > 1:
+            fronts = _levenshtein(a[alo:ahi], b[blo:bhi], deadline)
+        if fronts is not None:
+            _trace(
+                list1, list2, ahi - alo, bhi - blo, fronts, alo, blo,
+                operations,
+            )
+        else:
+            _replaced(list1, list2, a, b, alo, ahi, blo, bhi, deadline,
+                      operations)
+    return len(operations), operations
+
+
+def _anchors(a, b, alo, ahi, blo, bhi):
+    # (i, j) of rows occurring once in each range, the longest run of them
+    # in the same order on both sides
+    counts = {}
+    for row in a[alo:ahi]:
+        counts[row] = counts.get(row, 0) + 1
+    positions = {}
+    for j in range(blo, bhi):
+        row = b[j]
+        if counts.get(row) == 1:
+            positions[row] = None if row in positions else j
+    pairs = [
+        (i, positions[a[i]]) for i in range(alo, ahi)
+        if positions.get(a[i]) is not None
+    ]
+    # longest increasing subsequence of j, by patience sorting
+    tails = []
+    links = []
+    for index, (i, j) in enumerate(pairs):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if pairs[tails[middle]][1] < j:
+                low = middle + 1
+            else:
+                high = middle
+        links.append(tails[low - 1] if low else None)
+        if low == len(tails):
+            tails.append(index)
+        else:
+            tails[low] = index
+    anchors = []
+    index = tails[-1] if tails else None
+    while index is not None:
+        anchors.append(pairs[index])
+        index = links[index]
+    anchors.reverse()
+    return anchors
+
+
+def _replaced(list1, list2, a, b, alo, ahi, blo, bhi, deadline, operations):
+    # Myers on the range, gaps between its matches as replaced blocks
+    pending = None
+    for gap in _gaps(a[alo:ahi], b[blo:bhi], deadline):
+        gap = (gap[0] + alo, gap[1] + alo, gap[2] + blo, gap[3] + blo)
+        # adjacent gaps come out of the search separately, join them
+        if pending and pending[1] == gap[0] and pending[3] == gap[2]:
+            pending = (pending[0], gap[1], pending[2], gap[3])
+            continue
+        if pending:
+            _operations(list1, list2, pending, operations)
+        pending = gap
+    if pending:
+        _operations(list1, list2, pending, operations)
+
+
+def _operations(list1, list2, gap, operations):
+    alo, ahi, blo, bhi = gap
+    common = min(ahi - alo, bhi - blo)
+    for i, j in zip(range(alo, alo + common), range(blo, blo + common)):
+        operations.append(("substitute", list1[i], list2[j], i, j))
+    for i in range(alo + common, ahi):
+        operations.append(("delete", list1[i], i))
+    for j in range(blo + common, bhi):
+        operations.append(("insert", list2[j], j))
+
+
+def _shift(operation, start):
+    if operation[0] == "substitute":
+        return operation[:3] + (operation[3] + start, operation[4] + start)
+    return operation[:2] + (operation[2] + start,)
+
+
+def common_prefix(operations, length1, length2):
+    # length of the equal prefix, given the operations of a diff
+    if not operations:
+        return min(length1, length2)
+    first = operations[0]
+    return first[3] if first[0] == "substitute" else first[2]
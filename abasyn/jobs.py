@@ -0,0 +1,146 @@
+import datetime
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from sysutils import logger, config
+
+# Background jobs for API calls doing slow database work, so that they do
+# not hold web server threads. A fixed number of daemon workers take jobs
+# from a bounded queue; finished jobs are kept for ttl seconds, at most
+# max_results of them, least recently looked at going first. Submitting a
+# job identical to one still queued or running returns that job instead.
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+class Job:
+    def __init__(self, kind, func, args):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.state = "queued"
+        self.result = None
+        self.error = None
+        self.submitted = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def run(self):
+        self.state = "running"
+        self.started = time.monotonic()
+        try:
+            self.result = self.func(*self.args)
+            self.state = "done"
+        except Exception as e:
+            logger.error(f"Job {self.kind} {self.id} failed, error: {e}")
+            self.error = str(e)
+            self.state = "failed"
+        self.finished = time.monotonic()
+        self.done.set()
+
+    def status(self):
+        seconds = None
+        if self.started is not None:
+            seconds = round((self.finished or time.monotonic())
+                            - self.started, 3)
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.state,
+            "submitted": self.submitted,
+            "seconds": seconds,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    def __init__(self, workers=4, max_pending=100, max_results=256, ttl=3600):
+        self.queue = queue.Queue(max_pending)
+        self.max_results = max_results
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.active = {}
+        self.threads = [
+            threading.Thread(target=self.work, name=f"job-{n}", daemon=True)
+            for n in range(max(1, workers))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            job.run()
+            with self.lock:
+                self.active.pop((job.kind, job.args), None)
+
+    def submit(self, kind, func, *args):
+        # returns the job, or None when the queue is full
+        with self.lock:
+            job = self.active.get((kind, args))
+            if job is not None:
+                return job
+            job = Job(kind, func, args)
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                logger.error(f"Job queue is full, rejecting {kind}")
+                return None
+            self.active[(kind, args)] = job
+            self.jobs[job.id] = job
+            self.evict()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            self.evict()
+            job = self.jobs.get(job_id)
+            if job is not None:
+                self.jobs.move_to_end(job_id)
+            return job
+
+    def evict(self):
+        now = time.monotonic()
+        finished = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished is not None
+        ]
+        excess = len(self.jobs) - self.max_results
+        for job_id in finished:
+            job = self.jobs[job_id]
+            if now - job.finished > self.ttl or excess > 0:
+                del self.jobs[job_id]
+                excess -= 1
+
+    def stats(self):
+        with self.lock:
+            states = {}
+            for job in self.jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+        return {
+            "workers": len(self.threads),
+            "pending": self.queue.qsize(),
+            "jobs": states,
+        }
+
+
+def job_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                settings = config.get("jobs", {})
+                _manager = JobManager(
+                    workers=settings.get("workers", 4),
+                    max_pending=settings.get("max_pending", 100),
+                    max_results=settings.get("max_results", 256),
+                    ttl=settings.get("ttl", 3600),
+                )
+    return _manager
@@ -0,0 +1,164 @@
+import bisect
+import threading
+
+# Minimal metrics in the Prometheus text exposition format. Observations
+# take one uncontended lock and a bisect, so they can stay in hot loops.
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30, 60,
+)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+registry = []
+
+
+def escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
+
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def header(self):
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [
+            f"{self.name}{format_labels(self.labels, key)} "
+            f"{format_value(value)}"
+            for key, value in items
+        ]
+
+    def remove(self, *labels):
+        with self.lock:
+            self.values.pop(labels, None)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        if not self.labels:
+            self.values[()] = 0
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class GaugeCallback(Metric):
+    # values are collected from func() at scrape time, as {labels: value}
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, func):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def samples(self):
+        with self.lock:
+            self.values = dict(self.func())
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0, 0,
+                ]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def summary(self, *labels):
+        # (sum, count) of the observations with the given labels
+        with self.lock:
+            state = self.values.get(labels)
+            return (state[1], state[2]) if state else (0, 0)
+
+    def samples(self):
+        with self.lock:
+            items = [
+                (key, list(state[0]), state[1], state[2])
+                for key, state in self.values.items()
+            ]
+        lines = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket in zip(
+                self.buckets + (float("inf"),), counts
+            ):
+                cumulative += bucket
+                le = format_labels(
+                    self.labels, key, ("le", format_value(bound))
+                )
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in list(registry):
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            samples = []
+            lines.append(f"# {metric.name} failed: {escape(e)}")
+        lines.extend(metric.header())
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
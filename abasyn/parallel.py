@@ -0,0 +1,187 @@
+import time
+from apply import ApplyEngine
+import record
+from compact import TABLE
+from sysutils import logger
+
+# Applies a receiver's changes over several connections at once. Each
+# transaction window is split by table into partitions which keep their
+# order; document headers, their detail tables (named after the header)
+# and tables missing from RPL_TABLES all share the first connection, the
+# reference tables are spread over the others. Partitions are committed
+# only once all of them went through, a database error in any of them
+# rolls the window back and replays it serially for a while. A partition
+# blocked on a row another one changed, e.g. a foreign key, would wait
+# for a commit that never comes, so the connections are opened with a
+# lock timeout and such a conflict is an error like any other. With
+# checkpoints, every connection records how far it got under its own slot
+# and the first one is committed last, so its position is always safe to
+# resume from.
+
+FOREVER = float("inf")
+
+
+class ParallelEngine:
+    def __init__(
+        self,
+        connections,
+        executor,
+        backend,
+        tables,
+        group_size=50,
+        commit_rows=1000,
+        commit_interval=500,
+        on_commit=None,
+        cooldown=300,
+        checkpoint=None,
+    ):
+        self.backend = backend
+        self.engines = [
+            ApplyEngine(
+                con, backend, group_size,
+                commit_rows=FOREVER, commit_interval=FOREVER,
+                checkpoint=slot_checkpoint(checkpoint, slot),
+            )
+            for slot, con in enumerate(connections)
+        ]
+        self.headers = [
+            name for name, (allfields, docheader) in tables.items()
+            if docheader
+        ]
+        self.tables = tables
+        self.slots = {}
+        self.commit_rows = max(1, commit_rows)
+        self.commit_interval = commit_interval / 1000
+        self.on_commit = on_commit
+        self.cooldown = cooldown
+        self.executor = executor
+        self.pending = []
+        self.last_id = None
+        self.committed_id = None
+        self.rows_committed = 0
+        self.commits = 0
+        self.commit_seconds = 0
+        self.last_commit = time.monotonic()
+        self.conflicts = 0
+        self.serial_until = 0
+        self.tolerant_until = 0
+
+    def slot(self, sql):
+        if record.is_record(sql):
+            table = record.table(sql)
+        else:
+            match = TABLE.match(sql)
+            table = match.group(1).lower() if match else None
+        slot = self.slots.get(table)
+        if slot is None:
+            slot = self.slots[table] = self.place(table)
+        return slot
+
+    def place(self, table):
+        if (
+            len(self.engines) == 1
+            or table not in self.tables
+            or self.tables[table][1]
+            or any(table.startswith(header) for header in self.headers)
+        ):
+            return 0
+        # round robin over the other connections, in order of appearance
+        placed = sum(1 for slot in self.slots.values() if slot)
+        return 1 + placed % (len(self.engines) - 1)
+
+    def apply(self, change_id, sql):
+        self.pending.append((change_id, sql))
+        self.last_id = change_id
+        if (
+            len(self.pending) >= self.commit_rows
+            or time.monotonic() - self.last_commit >= self.commit_interval
+        ):
+            self.commit()
+
+    def advance(self, change_id):
+        self.last_id = change_id
+
+    def run_partition(self, engine, changes):
+        for change_id, sql in changes:
+            engine.apply(change_id, sql)
+        engine.flush()
+
+    def apply_parallel(self):
+        # returns the partitions applied but not committed yet
+        partitions = {}
+        for change in self.pending:
+            partitions.setdefault(self.slot(change[1]), []).append(change)
+        futures = [
+            self.executor.submit(
+                self.run_partition, self.engines[slot], changes
+            )
+            for slot, changes in partitions.items()
+        ]
+        # wait for every partition before deciding, then raise the first
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+        return partitions
+
+    def apply_serial(self):
+        engine = self.engines[0]
+        engine.tolerant_until = self.tolerant_until
+        for change_id, sql in self.pending:
+            engine.apply(change_id, sql)
+        engine.advance(self.last_id)
+        started = time.perf_counter()
+        engine.commit()
+        return time.perf_counter() - started
+
+    def commit(self):
+        if self.pending or self.last_id != self.committed_id:
+            if not self.pending:
+                seconds = 0
+            elif (
+                time.monotonic() < self.serial_until
+                or self.pending[0][0] <= self.tolerant_until
+            ):
+                seconds = self.apply_serial()
+            else:
+                try:
+                    partitions = self.apply_parallel()
+                except self.backend.DatabaseError as e:
+                    self.conflicts += 1
+                    self.serial_until = time.monotonic() + self.cooldown
+                    logger.warning(
+                        f"Parallel apply failed, falling back to serial "
+                        f"for {self.cooldown} seconds: {e}"
+                    )
+                    for engine in self.engines:
+                        engine.rollback()
+                    seconds = self.apply_serial()
+                else:
+                    # a failure past this point leaves earlier partitions
+                    # committed, so it is not retried serially
+                    started = time.perf_counter()
+                    self.engines[0].advance(self.last_id)
+                    for slot in sorted(set(partitions) | {0}, reverse=True):
+                        self.engines[slot].commit()
+                    seconds = time.perf_counter() - started
+            self.commit_seconds = seconds
+            self.commits += 1
+            self.committed_id = self.last_id
+            self.rows_committed += len(self.pending)
+            self.pending = []
+            logger.debug("Committed changes up to %s", self.committed_id)
+            if self.on_commit is not None:
+                self.on_commit(self.committed_id)
+        self.last_commit = time.monotonic()
+
+    def rollback(self):
+        self.pending = []
+        self.last_id = self.committed_id
+        for engine in self.engines:
+            engine.rollback()
+
+
+def slot_checkpoint(checkpoint, slot):
+    if checkpoint is None:
+        return None
+    return lambda cursor, last_id: checkpoint(cursor, last_id, slot)
@@ -0,0 +1,151 @@
+import threading
+import time
+from contextlib import contextmanager
+from sysutils import logger
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        connect,
+        max_size=5,
+        idle_timeout=300,
+        check_after=30,
+        wait_timeout=30,
+    ):
+        self.connect = connect
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.wait_timeout = wait_timeout
+        self.condition = threading.Condition()
+        self.idle = []
+        self.in_use = 0
+        self.closed = False
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.broken = 0
+        self.waits = 0
+        self.timeouts = 0
+
+    def evict_idle(self):
+        # idle connections are kept most recently used last
+        now = time.monotonic()
+        while self.idle and now - self.idle[0][1] > self.idle_timeout:
+            con, since = self.idle.pop(0)
+            self.evicted += 1
+            self.close_connection(con)
+
+    def close_connection(self, con):
+        try:
+            con.close()
+        except Exception as e:
+            logger.debug(f"Failed to close pooled connection: {e}")
+
+    def healthy(self, con):
+        try:
+            cur = con.cursor()
+            cur.execute("select 1 from rdb$database")
+            cur.fetchone()
+            con.rollback()
+            return True
+        except Exception as e:
+            logger.info(f"Dropping broken pooled connection: {e}")
+            return False
+
+    def acquire(self, wait_timeout=None, connect=None):
+        # connect, if given, replaces the factory for this call
+        if wait_timeout is None:
+            wait_timeout = self.wait_timeout
+        deadline = time.monotonic() + wait_timeout
+        con = None
+        with self.condition:
+            while True:
+                if self.closed:
+                    return None
+                self.evict_idle()
+                if self.idle:
+                    con, since = self.idle.pop()
+                    self.in_use += 1
+                    break
+                if self.in_use < self.max_size:
+                    self.in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    logger.error("Timed out waiting for a pooled connection")
+                    return None
+                self.waits += 1
+                self.condition.wait(remaining)
+        if con is not None:
+            fresh = time.monotonic() - since < self.check_after
+            if fresh or self.healthy(con):
+                self.reused += 1
+                return con
+            self.broken += 1
+            self.close_connection(con)
+            con = None
+        try:
+            con = (connect or self.connect)()
+        finally:
+            with self.condition:
+                if con is None:
+                    self.in_use -= 1
+                    self.condition.notify()
+                else:
+                    self.created += 1
+        return con
+
+    def release(self, con, broken=False):
+        if not broken:
+            try:
+                # never hand over a connection with an open transaction
+                con.rollback()
+            except Exception:
+                broken = True
+        with self.condition:
+            self.in_use -= 1
+            if broken or self.closed:
+                if broken:
+                    self.broken += 1
+                self.close_connection(con)
+            else:
+                self.idle.append((con, time.monotonic()))
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self, wait_timeout=None, connect=None):
+        con = self.acquire(wait_timeout, connect)
+        broken = False
+        try:
+            yield con
+        except Exception:
+            broken = True
+            raise
+        finally:
+            if con is not None:
+                self.release(con, broken)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            while self.idle:
+                self.close_connection(self.idle.pop()[0])
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            self.evict_idle()
+            return {
+                "max_size": self.max_size,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "created": self.created,
+                "reused": self.reused,
+                "evicted": self.evicted,
+                "broken": self.broken,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+            }
@@ -0,0 +1,133 @@
+import base64
+import functools
+import json
+import re
+
+# Structured change records, an alternative to literal SQL in rpl_sql for
+# triggers that write them. A record is a JSON object:
+#
+#   {"table": "R_TOVAR", "op": "update", "key": {"ID": 5},
+#    "values": {"PRICE": 10.5, "PHOTO": {"base64": "..."}}}
+#
+# op is insert, update, delete or upsert (update or insert matching the
+# key). Values go to the receiver as parameters of a statement that only
+# depends on the table, the operation and the columns, so statements are
+# prepared once per shape and nothing is quoted. The apply engine groups
+# records like literal statements: on Firebird a group is one execute
+# block with typed parameters, on sqlite runs of one shape use
+# executemany. Anything not starting with "{" is literal SQL.
+
+TABLE = re.compile(r'"table"\s*:\s*"(\w+)"')
+NAME = re.compile(r"\w+")
+OPERATIONS = ("insert", "update", "delete", "upsert")
+
+
+def is_record(text):
+    return text[:1] == "{"
+
+
+def table(text):
+    # without decoding the whole record
+    match = TABLE.search(text)
+    return match.group(1).lower() if match else None
+
+
+def value(item):
+    if isinstance(item, dict) and "base64" in item:
+        return base64.b64decode(item["base64"])
+    if isinstance(item, bool):
+        return int(item)
+    return item
+
+
+def values(items):
+    return [
+        value(item) if isinstance(item, (dict, bool)) else item
+        for item in items
+    ]
+
+
+def decode(text):
+    # (table, op, key, values) with upper case column names
+    change = json.loads(text)
+    key = change.get("key") or {}
+    fields = change.get("values") or {}
+    # validates the shape
+    statement(change.get("table"), change.get("op"), tuple(key),
+              tuple(fields))
+    return (
+        change["table"].lower(),
+        change["op"],
+        dict(zip(map(str.upper, key), values(key.values()))),
+        dict(zip(map(str.upper, fields), values(fields.values()))),
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def statement(table, op, key_columns, value_columns):
+    # the statement of a record shape, or ValueError, which is not cached
+    if (
+        op not in OPERATIONS
+        or not NAME.fullmatch(table or "")
+        or not all(NAME.fullmatch(c) for c in key_columns + value_columns)
+    ):
+        raise ValueError(f"Malformed change record of {table!r}")
+    if op != "insert" and not key_columns:
+        raise ValueError(f"Change record of {table} without a key")
+    if (op == "update" and not value_columns) or not (
+        key_columns or value_columns
+    ):
+        raise ValueError(f"Change record of {table} without values")
+    table = table.lower()
+    keys = [column.upper() for column in key_columns]
+    if op in ("insert", "upsert"):
+        columns = keys + [
+            column.upper() for column in value_columns
+            if column not in key_columns
+        ]
+        sql = (
+            f"insert into {table} ({', '.join(columns)}) "
+            f"values ({', '.join('?' * len(columns))})"
+        )
+        if op == "upsert":
+            sql = f"update or {sql} matching ({', '.join(keys)})"
+        return sql
+    where = " and ".join(f"{column} = ?" for column in keys)
+    if op == "delete":
+        return f"delete from {table} where {where}"
+    assignments = ", ".join(
+        f"{column.upper()} = ?" for column in value_columns
+    )
+    return f"update {table} set {assignments} where {where}"
+
+
+def merge(texts):
+    # one update record with the values of successive updates of a row,
+    # later values win
+    fields = {}
+    for text in texts:
+        change = json.loads(text)
+        fields.update(
+            (column.upper(), item)
+            for column, item in (change.get("values") or {}).items()
+        )
+    change["values"] = fields
+    return json.dumps(change)
+
+
+def bind(text):
+    # (sql, params) of a record
+    change = json.loads(text)
+    op = change.get("op")
+    key = change.get("key") or {}
+    fields = change.get("values") or {}
+    sql = statement(change.get("table"), op, tuple(key), tuple(fields))
+    if op in ("insert", "upsert"):
+        params = values(key.values()) + values(
+            item for column, item in fields.items() if column not in key
+        )
+    elif op == "delete":
+        params = values(key.values())
+    else:
+        params = values(fields.values()) + values(key.values())
+    return sql, params
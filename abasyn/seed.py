@@ -0,0 +1,368 @@
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import db
+from backend import get_backend
+from sysutils import logger, config
+
+# Initial copy of every RPL_TABLES table to a receiver. The rpl_log head is
+# recorded before the copy starts and becomes the receiver's position, so
+# incremental replication picks up from there once the copy is complete.
+# Tables are copied concurrently in batches of prepared "update or insert"
+# statements, which makes a copy safe to repeat: the progress of each table
+# is kept in a state file and an interrupted seed resumes where it stopped.
+# Changes logged while copying may already be in the copy, so up to the log
+# head at the end of the seed they are applied tolerating failures. A seed
+# that cannot complete holds up replication to its receiver until it is
+# cancelled, which drops its state and leaves the receiver as it is.
+
+_seeders = {}
+_states = {}
+_state_lock = threading.Lock()
+
+
+def state_path(receiver_id, source=None):
+    directory = db.source_directory(
+        config.get("seed", {}).get("directory", "seed"), source
+    )
+    return os.path.join(directory, f"{receiver_id}.json")
+
+
+def load_state(receiver_id, source=None):
+    source = db.source_name(source)
+    key = (source, int(receiver_id))
+    with _state_lock:
+        if key not in _states:
+            try:
+                with open(state_path(receiver_id, source)) as f:
+                    _states[key] = json.load(f)
+            except FileNotFoundError:
+                _states[key] = None
+        return _states[key]
+
+
+def save_state(receiver_id, state, source=None):
+    source = db.source_name(source)
+    key = (source, int(receiver_id))
+    path = state_path(receiver_id, source)
+    with _state_lock:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f, indent=1, default=str)
+        os.replace(path + ".tmp", path)
+        _states[key] = state
+
+
+def clear_state(receiver_id, source=None):
+    source = db.source_name(source)
+    with _state_lock:
+        try:
+            os.remove(state_path(receiver_id, source))
+        except FileNotFoundError:
+            pass
+        _states[(source, int(receiver_id))] = None
+
+
+def in_progress(receiver_id, source=None):
+    # replication to the receiver waits until its seed is complete
+    state = load_state(receiver_id, source)
+    return state is not None and state["state"] != "done"
+
+
+def tolerant_until(receiver_id, source=None):
+    state = load_state(receiver_id, source)
+    if state is None or state["state"] != "done":
+        return 0
+    return state["hwm_end"]
+
+
+class Seeder(threading.Thread):
+    def __init__(self, receiver_id, source=None):
+        super().__init__(daemon=True)
+        settings = config.get("seed", {})
+        self.receiver_id = int(receiver_id)
+        self.source = db.source_name(source)
+        self.workers = settings.get("workers", 4)
+        self.batch_size = settings.get("batch_size", 5000)
+        self.clear = settings.get("clear", True)
+        self.passes = settings.get("passes", 3)
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.state = None
+        self.phase = "starting"
+        self.started = time.time()
+        self.error = None
+
+    def save(self):
+        with self.lock:
+            # a cancelled seed has no state any more
+            if not self.cancelled.is_set():
+                save_state(self.receiver_id, self.state, self.source)
+
+    def stopping(self):
+        return db.stop_event.is_set() or self.cancelled.is_set()
+
+    def prepare(self, receiver):
+        self.state = load_state(self.receiver_id, self.source)
+        if self.state is not None and self.state["state"] != "done":
+            logger.info(f"Resuming the seed of receiver {self.receiver_id}")
+            return
+        with db.local_pool(self.source).connection() as local:
+            if local is None:
+                raise RuntimeError("Local database is not available")
+            cur = local.cursor()
+            cur.execute("select table_name from rpl_tables")
+            tables = [row[0].strip().lower() for row in cur.fetchall()]
+            cur.execute("select max(id) from rpl_log")
+            hwm = cur.fetchone()[0] or 0
+            local.commit()
+        self.state = {
+            "state": "copying",
+            "alias": receiver[0],
+            "started": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "hwm_start": hwm,
+            "hwm_end": None,
+            "tables": {
+                table: {"state": "pending", "rows": 0, "last_key": None}
+                for table in tables
+            },
+        }
+        self.save()
+        # the worker notices the seed between pages, let it finish one
+        spool = db.open_spool(self.receiver_id, self.source)
+        for worker in db.listener_workers(self.source):
+            if worker.receiver_id == self.receiver_id:
+                while worker.state == "processing":
+                    time.sleep(0.1)
+                worker.last_id = hwm
+                spool = worker.spool
+        # whatever was spooled is older than the copy
+        if spool is not None:
+            spool.acknowledge(hwm)
+            spool.release()
+        with db.local_pool(self.source).connection() as local:
+            cur = local.cursor()
+            sql = "update rpl_databases set last_id = ? where id = ?"
+            cur.execute(sql, [hwm, self.receiver_id])
+            local.commit()
+        # and so is any checkpoint the receiver kept
+        remote = db.open_receiver(*receiver[1:])
+        if remote is None:
+            raise RuntimeError("Receiver is not available")
+        try:
+            db.reset_checkpoint(remote, self.source, hwm)
+        finally:
+            remote.close()
+
+    def copy_table(self, table, receiver):
+        progress = self.state["tables"][table]
+        backend = get_backend()
+        local = db.connect_to_database(**db.source_database(self.source))
+        remote = None
+        try:
+            remote = db.open_receiver(*receiver[1:])
+            if local is None or remote is None:
+                raise RuntimeError("database is not available")
+            localcur = local.cursor()
+            remotecur = remote.cursor()
+            key = backend.primary_key(localcur, table)
+            if progress["state"] == "pending" or (
+                not key and progress["state"] != "done"
+            ):
+                # without a key a partial copy can only be started over
+                if self.clear:
+                    remotecur.execute(f"delete from {table}")
+                    remote.commit()
+                with self.lock:
+                    progress.update(state="copying", rows=0, last_key=None)
+                self.save()
+            sql = f"select * from {table}"
+            params = []
+            if len(key) == 1 and progress["last_key"] is not None:
+                sql += f" where {key[0]} > ?"
+                params.append(progress["last_key"])
+            if key:
+                sql += " order by " + ", ".join(key)
+            localcur.execute(sql, params)
+            columns = [column[0].strip() for column in localcur.description]
+            # update or insert needs a key to match on, a table without
+            # one was cleared above
+            insert = (
+                f"insert into {table} ({', '.join(columns)}) "
+                f"values ({', '.join('?' * len(columns))})"
+            )
+            if key:
+                insert = "update or " + insert
+                insert += f" matching ({', '.join(key)})"
+                position = [c.upper() for c in columns].index(key[0].upper())
+            while not self.stopping():
+                rows = localcur.fetchmany(self.batch_size)
+                if not rows:
+                    with self.lock:
+                        progress["state"] = "done"
+                        progress.pop("error", None)
+                    break
+                remotecur.executemany(insert, rows)
+                remote.commit()
+                with self.lock:
+                    progress["rows"] += len(rows)
+                    if len(key) == 1:
+                        progress["last_key"] = rows[-1][position]
+                self.save()
+            self.save()
+        finally:
+            for con in (local, remote):
+                try:
+                    if con is not None:
+                        con.close()
+                except Exception as e:
+                    logger.debug(f"Failed to close connection: {e}")
+
+    def copy_tables(self, receiver):
+        tables = queue.Queue()
+        for table, progress in self.state["tables"].items():
+            if progress["state"] != "done":
+                tables.put(table)
+
+        def work():
+            while not self.stopping():
+                try:
+                    table = tables.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.copy_table(table, receiver)
+                except Exception as e:
+                    # e.g. a foreign key to a table not copied yet
+                    logger.warning(f"Failed to seed {table}, error: {e}")
+                    with self.lock:
+                        self.state["tables"][table]["error"] = str(e)
+
+        threads = [
+            threading.Thread(target=work, daemon=True)
+            for _ in range(max(1, self.workers))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def seed(self):
+        with db.local_pool(self.source).connection() as local:
+            if local is None:
+                raise RuntimeError("Local database is not available")
+            cur = local.cursor()
+            sql = ("SELECT alias, dbname, dbuser, dbpass FROM rpl_databases"
+                   " WHERE id = ?")
+            cur.execute(sql, [self.receiver_id])
+            receiver = cur.fetchone()
+        if receiver is None:
+            raise RuntimeError("receiver not found")
+        self.prepare(receiver)
+        for attempt in range(self.passes):
+            self.phase = f"copying, pass {attempt + 1}"
+            self.copy_tables(receiver)
+            if db.stop_event.is_set():
+                raise RuntimeError("stopped by the service shutdown")
+            if self.cancelled.is_set():
+                raise RuntimeError("cancelled")
+            if self.remaining() == 0:
+                break
+        if self.remaining():
+            raise RuntimeError(f"{self.remaining()} tables failed to copy")
+        with db.local_pool(self.source).connection() as local:
+            cur = local.cursor()
+            cur.execute("select max(id) from rpl_log")
+            self.state["hwm_end"] = cur.fetchone()[0] or 0
+        self.state["state"] = "done"
+        self.state["finished"] = datetime.datetime.now().strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+        self.save()
+        for worker in db.listener_workers(self.source):
+            if worker.receiver_id == self.receiver_id:
+                worker.queue.put()
+        logger.info(
+            f"Seeded receiver {self.receiver_id}, replicating from "
+            f"{self.state['hwm_start']}"
+        )
+
+    def remaining(self):
+        return sum(
+            1 for progress in self.state["tables"].values()
+            if progress["state"] != "done"
+        )
+
+    def run(self):
+        try:
+            self.seed()
+            self.phase = "done"
+        except Exception as e:
+            self.error = str(e)
+            self.phase = "failed"
+            logger.error(
+                f"Seeding receiver {self.receiver_id} failed, error: {e}"
+            )
+
+    def status(self):
+        with self.lock:
+            state = json.loads(json.dumps(self.state, default=str))
+        rows = 0
+        if state is not None:
+            rows = sum(t["rows"] for t in state["tables"].values())
+        elapsed = time.time() - self.started
+        return {
+            "status": self.phase,
+            "error": self.error,
+            "rows": rows,
+            "rows_per_sec": round(rows / elapsed, 1) if elapsed else 0,
+            "seed": state,
+        }
+
+
+def start_seed(receiver_id, source=None):
+    source = db.source_name(source)
+    key = (source, int(receiver_id))
+    with db.lock:
+        seeder = _seeders.get(key)
+        if seeder is None or not seeder.is_alive():
+            seeder = _seeders[key] = Seeder(receiver_id, source)
+            seeder.start()
+    return seeder.status()
+
+
+def cancel_seed(receiver_id, source=None, timeout=30):
+    # stops a running seed and forgets it, replication to the receiver
+    # continues from the position the seed set
+    source = db.source_name(source)
+    key = (source, int(receiver_id))
+    with db.lock:
+        seeder = _seeders.pop(key, None)
+    if seeder is not None:
+        with seeder.lock:
+            seeder.cancelled.set()
+        seeder.join(timeout)
+    if load_state(receiver_id, source) is None and seeder is None:
+        return {"status": "not started"}
+    clear_state(receiver_id, source)
+    logger.warning(
+        f"Seed of receiver {receiver_id} cancelled, its tables may be "
+        f"incomplete"
+    )
+    for worker in db.listener_workers(source):
+        if worker.receiver_id == int(receiver_id):
+            worker.queue.put()
+    return {"status": "cancelled"}
+
+
+def seed_status(receiver_id, source=None):
+    seeder = _seeders.get((db.source_name(source), int(receiver_id)))
+    if seeder is not None:
+        return seeder.status()
+    state = load_state(receiver_id, source)
+    if state is None:
+        return {"status": "not started"}
+    return {"status": state["state"], "seed": state}
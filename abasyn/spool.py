@@ -0,0 +1,198 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from sysutils import logger
+
+# Append-only spool of rpl_log pages for a receiver which cannot be reached,
+# so that the master can trim rpl_log meanwhile. Segment files are named
+# after the first change id they hold and contain records of
+#   length, crc32 | first id, last id, rows | zlib compressed JSON page
+# where the crc covers everything after it. A torn record at the end of the
+# last segment, left by a crash mid-write, is cut off when the spool opens.
+# replay.pos keeps the last change id committed on the receiver.
+
+HEADER = struct.Struct(">II")
+META = struct.Struct(">qqI")
+POSITION = "replay.pos"
+
+
+class Spool:
+    def __init__(
+        self, directory, max_size=1024 << 20, segment_size=64 << 20
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.replayed_id = self.read_position()
+        # segment name: [size, [(last id, rows, first id, offset), ...]]
+        self.segments = {}
+        # (segment, offset, after, rows) of the page replayed_id falls in
+        self.partial = None
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".seg"):
+                self.segments[name] = self.scan(name)
+        self.drop_replayed()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_position(self):
+        try:
+            with open(self.path(POSITION)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def records(self, name):
+        # (offset, record size, first id, last id, rows, payload view)
+        with open(self.path(name), "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + HEADER.size + META.size <= len(data):
+                    length, crc = HEADER.unpack_from(data, offset)
+                    start = offset + HEADER.size
+                    end = start + META.size + length
+                    if end > len(data):
+                        break
+                    body = data[start:end]
+                    if zlib.crc32(body) != crc:
+                        break
+                    first_id, last_id, rows = META.unpack_from(body)
+                    yield (offset, end - offset, first_id, last_id, rows,
+                           body[META.size:])
+                    offset = end
+
+    def scan(self, name):
+        size = 0
+        records = []
+        for offset, length, first_id, last_id, rows, _ in self.records(name):
+            size = offset + length
+            records.append((last_id, rows, first_id, offset))
+        if size != os.path.getsize(self.path(name)):
+            logger.warning(
+                f"Cutting a damaged tail off spool segment {name} at {size}"
+            )
+            os.truncate(self.path(name), size)
+        return [size, records]
+
+    def size(self):
+        with self.lock:
+            return sum(segment[0] for segment in self.segments.values())
+
+    def full(self):
+        return self.size() >= self.max_size
+
+    def depth(self):
+        # rows spooled but not yet committed on the receiver
+        total = 0
+        partial = None
+        with self.lock:
+            after = self.replayed_id
+            for name, (size, records) in self.segments.items():
+                for last_id, rows, first_id, offset in records:
+                    if first_id > after:
+                        total += rows
+                    elif last_id > after:
+                        partial = (name, offset, rows)
+        if partial:
+            total += self.rows_after(*partial, after)
+        return total
+
+    def rows_after(self, name, offset, rows, after):
+        # rows above after in a partly acknowledged page, decoded once
+        cached = self.partial
+        if cached and cached[:3] == (name, offset, after):
+            return cached[3]
+        try:
+            with open(self.path(name), "rb") as f:
+                f.seek(offset)
+                length, crc = HEADER.unpack(f.read(HEADER.size))
+                body = f.read(META.size + length)
+        except (OSError, struct.error):
+            # dropped by a release meanwhile, the page is an upper bound
+            return rows
+        changes = json.loads(zlib.decompress(body[META.size:]))
+        count = sum(1 for c in changes if c[0] > after)
+        self.partial = (name, offset, after, count)
+        return count
+
+    def spooled_id(self):
+        with self.lock:
+            if not self.segments:
+                return self.replayed_id
+            return self.segments[max(self.segments)][1][-1][0]
+
+    def append(self, changes):
+        # durable once this returns, the master may forget the changes then
+        payload = zlib.compress(
+            json.dumps(changes, separators=(",", ":")).encode("utf-8"), 6
+        )
+        body = META.pack(changes[0][0], changes[-1][0], len(changes)) + payload
+        record = HEADER.pack(len(payload), zlib.crc32(body)) + body
+        with self.lock:
+            name = max(self.segments) if self.segments else None
+            if name is None or self.segments[name][0] >= self.segment_size:
+                name = f"{changes[0][0]:020d}.seg"
+                self.segments[name] = [0, []]
+            with open(self.path(name), "ab") as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            size = self.segments[name][0]
+            self.segments[name][0] += len(record)
+            self.segments[name][1].append(
+                (changes[-1][0], len(changes), changes[0][0], size)
+            )
+
+    def replay(self):
+        # spooled changes the receiver has not committed yet, in order
+        with self.lock:
+            after = self.replayed_id
+            names = [
+                name for name, (size, records) in sorted(self.segments.items())
+                if records and records[-1][0] > after
+            ]
+        for name in names:
+            for _, _, _, last_id, _, payload in self.records(name):
+                if last_id <= after:
+                    continue
+                changes = json.loads(zlib.decompress(payload))
+                yield [tuple(c) for c in changes if c[0] > after]
+
+    def acknowledge(self, change_id):
+        temporary = self.path(POSITION + ".tmp")
+        with open(temporary, "w") as f:
+            f.write(str(change_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path(POSITION))
+        with self.lock:
+            self.replayed_id = change_id
+
+    def release(self):
+        # segments stay mapped while a replay runs, drop them afterwards
+        with self.lock:
+            self.drop_replayed()
+
+    def drop_replayed(self):
+        for name, (size, records) in list(self.segments.items()):
+            if not records or records[-1][0] <= self.replayed_id:
+                os.remove(self.path(name))
+                del self.segments[name]
+
+    def status(self):
+        return {
+            "rows": self.depth(),
+            "bytes": self.size(),
+            "segments": len(self.segments),
+            "replayed_id": self.replayed_id,
+            "spooled_id": self.spooled_id(),
+            "full": self.full(),
+        }
@@ -1,31 +1,123 @@
 import logging
-import yaml
+import os
 import pathlib
 import sys
+import threading
 
 version = '3.0.1'
 
-# Load configuration from YAML file
+# Configuration is read from etc/abasyn.yml, or the file named by
+# ABASYN_CONFIG, the first time it is used rather than on import. Variables
+# like ABASYN__REPLICATION__BATCH_SIZE=500 override single values, parsed as
+# YAML. reload() reads everything again in place, so modules holding on to
+# config see the new values.
+
 path = pathlib.Path(__file__).parent.parent.absolute()
-cfg = path / "etc" / "abasyn.yml"
-with open(cfg, 'r') as f:
-    config = yaml.safe_load(f)
+ENV_PREFIX = "ABASYN__"
+
+
+class Config(dict):
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()
+        self.loaded = False
+
+    def source(self):
+        return pathlib.Path(
+            os.environ.get("ABASYN_CONFIG", path / "etc" / "abasyn.yml")
+        )
+
+    def load(self):
+        import yaml
+
+        with open(self.source(), 'r') as f:
+            data = yaml.safe_load(f) or {}
+        for name, value in os.environ.items():
+            if not name.startswith(ENV_PREFIX):
+                continue
+            keys = name[len(ENV_PREFIX):].lower().split("__")
+            section = data
+            for key in keys[:-1]:
+                section = section.setdefault(key, {})
+            section[keys[-1]] = yaml.safe_load(value)
+        return data
+
+    def ensure(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    super().update(self.load())
+                    self.loaded = True
+
+    def reload(self):
+        data = self.load()
+        # readers do not take the lock, so the config is never emptied:
+        # sections are replaced one by one, then the removed ones dropped
+        with self.lock:
+            super().update(data)
+            for key in [key for key in super().keys() if key not in data]:
+                super().__delitem__(key)
+            self.loaded = True
+
+    def __getitem__(self, key):
+        self.ensure()
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self.ensure()
+        super().__setitem__(key, value)
+
+    def __contains__(self, key):
+        self.ensure()
+        return super().__contains__(key)
+
+    def __iter__(self):
+        self.ensure()
+        return super().__iter__()
 
-# Set up logging
+    def __len__(self):
+        self.ensure()
+        return super().__len__()
+
+    def get(self, key, default=None):
+        self.ensure()
+        return super().get(key, default)
+
+    def keys(self):
+        self.ensure()
+        return super().keys()
+
+    def items(self):
+        self.ensure()
+        return super().items()
+
+    def values(self):
+        self.ensure()
+        return super().values()
+
+
+config = Config()
+
+# Handlers are attached by setup_logging(), until then nothing is written
 logger = logging.getLogger('abasyn')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.NullHandler())
 log_format = logging.Formatter(
     '%(asctime)s %(levelname)s %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S',
 )
-file_handler = logging.FileHandler(config['log']['file'])
-file_handler.setFormatter(log_format)
-logger.setLevel(logging.INFO)
 
-if sys.stdin and sys.stdin.isatty() and 'unittest' not in sys.modules.keys():
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(log_format)
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
-else:
-    logger.addHandler(file_handler)
-logger.propagate = False
+
+def setup_logging():
+    # safe to call again after a reload, handlers are replaced
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    settings = config.get('log', {})
+    logger.setLevel(settings.get('level', 'INFO'))
+    logger.addHandler(logging.FileHandler(settings.get('file', 'abasyn.log')))
+    if sys.stdin and sys.stdin.isatty() and 'unittest' not in sys.modules:
+        logger.addHandler(logging.StreamHandler())
+    for handler in logger.handlers:
+        handler.setFormatter(log_format)
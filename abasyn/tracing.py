@@ -0,0 +1,287 @@
+import collections
+import re
+import sys
+import threading
+import time
+from compact import TABLE
+from sysutils import logger, config
+
+# Tracing of the replication loop, off unless tracing.enabled is set or it
+# is switched on through /api/debug/trace. Every stage of a batch (pull,
+# apply, commit, cleanup) is recorded as a span: totals per receiver and
+# stage, plus the most recent spans. While tracing, statement groups are
+# timed on the receiver and the slowest statement shapes, i.e. the SQL with
+# its literals taken out, are kept per table. Callers check `active` before
+# doing any work, so disabled tracing costs one attribute lookup.
+#
+# The sampling profiler is separate and only runs on demand: it takes the
+# stacks of all threads every few milliseconds for a limited time.
+
+active = False
+_lock = threading.Lock()
+_stages = {}
+_recent = collections.deque(maxlen=256)
+_statements = {}
+_top = 20
+_profiler = None
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?")
+LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+MAX_STATEMENTS = 1000
+
+
+def configure():
+    global _top
+    settings = config.get("tracing", {})
+    _top = settings.get("slow_statements", 20)
+    enable(settings.get("enabled", False))
+
+
+def enable(flag=True):
+    global active
+    if flag and not active:
+        logger.info("Tracing enabled")
+    active = bool(flag)
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _recent.clear()
+        _statements.clear()
+
+
+class Span:
+    def __init__(self, stage, receiver, rows=None):
+        self.stage = stage
+        self.receiver = receiver
+        self.rows = rows
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(
+            self.stage, self.receiver, time.perf_counter() - self.started,
+            self.rows, error=exc[0] is not None,
+        )
+        return False
+
+
+class NullSpan:
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(stage, receiver, rows=None):
+    if not active:
+        return NULL_SPAN
+    return Span(stage, receiver, rows)
+
+
+def record(stage, receiver, seconds, rows=None, error=False):
+    if not active:
+        return
+    with _lock:
+        stats = _stages.get((receiver, stage))
+        if stats is None:
+            stats = _stages[(receiver, stage)] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        stats[3] += rows or 0
+        _recent.append((
+            time.time(), receiver, stage, round(seconds, 6), rows, error,
+        ))
+
+
+def shape(sql):
+    # the statement with its values replaced, so that updates of
+    # different rows count as one
+    sql = LITERALS.sub("?", sql)
+    return LISTS.sub("(...)", sql)[:200]
+
+
+def record_statements(statements, seconds):
+    # a group runs as one execute block, each statement gets its share
+    if not active or not statements:
+        return
+    share = seconds / len(statements)
+    with _lock:
+        for sql in statements:
+            match = TABLE.match(sql)
+            table = match.group(1).lower() if match else "?"
+            key = (table, shape(sql))
+            stats = _statements.get(key)
+            if stats is None:
+                if len(_statements) >= MAX_STATEMENTS:
+                    # forget the cheapest shape seen so far
+                    del _statements[min(
+                        _statements, key=lambda k: _statements[k][2]
+                    )]
+                stats = _statements[key] = [0, 0.0, 0.0, sql[:500]]
+            stats[0] += 1
+            stats[1] += share
+            if share > stats[2]:
+                stats[2] = share
+                stats[3] = sql[:500]
+
+
+def slow_statements(limit=None):
+    with _lock:
+        items = list(_statements.items())
+    items.sort(key=lambda item: item[1][2], reverse=True)
+    return [
+        {
+            "table": table,
+            "shape": statement,
+            "count": count,
+            "seconds": round(total, 6),
+            "avg_ms": round(total / count * 1000, 3),
+            "max_ms": round(slowest * 1000, 3),
+            "example": example,
+        }
+        for (table, statement), (count, total, slowest, example)
+        in items[:limit or _top]
+    ]
+
+
+def status():
+    with _lock:
+        stages = [
+            {
+                "receiver": receiver,
+                "stage": stage,
+                "count": count,
+                "seconds": round(total, 6),
+                "avg_ms": round(total / count * 1000, 3),
+                "max_ms": round(slowest * 1000, 3),
+                "rows": rows,
+            }
+            for (receiver, stage), (count, total, slowest, rows)
+            in _stages.items()
+        ]
+        recent = [
+            {
+                "time": time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(started)
+                ),
+                "receiver": receiver,
+                "stage": stage,
+                "seconds": seconds,
+                "rows": rows,
+                "error": error,
+            }
+            for started, receiver, stage, seconds, rows, error
+            in list(_recent)[-50:]
+        ]
+    return {
+        "enabled": active,
+        "stages": stages,
+        "slow_statements": slow_statements(),
+        "recent": recent,
+    }
+
+
+class Profiler(threading.Thread):
+    def __init__(self, seconds=30, interval=0.005, depth=40):
+        super().__init__(name="profiler", daemon=True)
+        self.seconds = seconds
+        self.interval = interval
+        self.depth = depth
+        self.stopped = threading.Event()
+        self.samples = 0
+        self.stacks = collections.Counter()
+        self.functions = collections.Counter()
+        self.started = None
+        self.finished = None
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}"
+                )
+                frame = frame.f_back
+            if not stack:
+                continue
+            self.functions[stack[0]] += 1
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        self.started = time.time()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline and not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+        self.finished = time.time()
+        logger.info(f"Profiler stopped after {self.samples} samples")
+
+    def stop(self):
+        self.stopped.set()
+
+    def status(self, limit=30):
+        return {
+            "status": "running" if self.is_alive() else "finished",
+            "samples": self.samples,
+            "interval": self.interval,
+            "seconds": round(
+                (self.finished or time.time()) - self.started, 3
+            ) if self.started else 0,
+            # leaf functions, where the threads were when sampled
+            "functions": [
+                {"function": name, "samples": count}
+                for name, count in self.functions.most_common(limit)
+            ],
+            # collapsed stacks, thread name first, for flame graph tools
+            "stacks": [
+                {"stack": stack, "samples": count}
+                for stack, count in self.stacks.most_common(limit)
+            ],
+        }
+
+
+def start_profiler(seconds=None, interval=None):
+    global _profiler
+    settings = config.get("tracing", {})
+    with _lock:
+        if _profiler is None or not _profiler.is_alive():
+            _profiler = Profiler(
+                seconds=min(seconds or settings.get("profile_seconds", 30),
+                            600),
+                interval=max(interval or settings.get("profile_interval",
+                                                      0.005), 0.001),
+            )
+            _profiler.start()
+            logger.info(f"Profiling for {_profiler.seconds} seconds")
+    return _profiler.status()
+
+
+def stop_profiler():
+    if _profiler is None:
+        return {"status": "not started"}
+    _profiler.stop()
+    _profiler.join()
+    return _profiler.status()
+
+
+def profiler_status():
+    if _profiler is None:
+        return {"status": "not started"}
+    return _profiler.status()
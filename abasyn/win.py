@@ -4,7 +4,8 @@ import win32event
 import servicemanager
 import socket
 import subprocess
-from app import app
+from app import create_app, start_replication, stop_replication
+from sysutils import setup_logging
 import sys
 
 
@@ -23,6 +24,7 @@ class AbasynService(win32serviceutil.ServiceFramework):
 
     def SvcStop(self):
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
+        stop_replication()
         win32event.SetEvent(self.stop_event)
         self.ReportServiceStatus(win32service.SERVICE_STOPPED)
 
@@ -35,6 +37,9 @@ class AbasynService(win32serviceutil.ServiceFramework):
         self.run_flask_app()
 
     def run_flask_app(self):
+        setup_logging()
+        app = create_app()
+        start_replication()
         app.run(host="0.0.0.0", port=5000)
 
 
@@ -0,0 +1,106 @@
+import argparse
+import json
+import pathlib
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "abasyn"))
+import record  # noqa: E402
+from compact import Compactor  # noqa: E402
+
+# Compacts random batches of changes to a few keys, written as literal SQL,
+# as change records or as a mix of both like old and new triggers produce,
+# and checks that applying a compacted batch leaves the same rows as
+# applying it whole.
+
+SCHEMA = "create table r_t (id integer primary key, a, b, c)"
+
+
+def make_batch(rnd, length, keys, formats):
+    present = set()
+    batch = []
+    for n in range(length):
+        key = rnd.randint(1, keys)
+        as_record = rnd.choice(formats) == "records"
+        if key not in present:
+            present.add(key)
+            if as_record:
+                change = {"table": "r_t", "op": "insert", "key": {"id": key},
+                          "values": {"a": n, "b": n, "c": n}}
+            else:
+                change = (f"insert into r_t (id, a, b, c) "
+                          f"values ({key}, {n}, {n}, {n})")
+        elif rnd.random() < 0.25:
+            present.discard(key)
+            if as_record:
+                change = {"table": "r_t", "op": "delete", "key": {"id": key}}
+            else:
+                change = f"delete from r_t where id = {key}"
+        elif as_record:
+            # records carry only the changed columns
+            columns = rnd.sample("abc", rnd.randint(1, 3))
+            change = {"table": "r_t", "op": "update", "key": {"id": key},
+                      "values": {
+                          c: n * 10 + i for i, c in enumerate(columns)
+                      }}
+        else:
+            # literal updates of RPL_ALLFIELDS tables carry the whole row
+            change = (f"update r_t set a = {n}, b = {n + 1}, c = {n + 2} "
+                      f"where id = {key}")
+        if isinstance(change, dict):
+            change = json.dumps(change)
+        batch.append((n + 1, change))
+    return batch
+
+
+def apply(batch):
+    # the rows left by the batch, or the error it ran into
+    con = sqlite3.connect(":memory:")
+    con.execute(SCHEMA)
+    try:
+        for change_id, sql in batch:
+            if record.is_record(sql):
+                con.execute(*record.bind(sql))
+            else:
+                con.execute(sql)
+    except sqlite3.Error as e:
+        return str(e)
+    return con.execute("select * from r_t order by id").fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check and benchmark rpl_log batch compaction"
+    )
+    parser.add_argument("--batches", type=int, default=3000)
+    parser.add_argument("--length", type=int, default=15)
+    parser.add_argument("--keys", type=int, default=3)
+    args = parser.parse_args()
+    print(f"{'changes':>12} {'batches':>8} {'ratio':>6} {'seconds':>8} "
+          f"{'wrong':>6}")
+    failed = False
+    for formats in (("sql",), ("records",), ("sql", "records")):
+        compactor = Compactor(["r_t"])
+        wrong = 0
+        seconds = 0.0
+        for seed in range(args.batches):
+            rnd = random.Random(seed)
+            batch = make_batch(
+                rnd, rnd.randint(1, args.length), args.keys, formats
+            )
+            started = time.perf_counter()
+            compacted = compactor.compact(batch)
+            seconds += time.perf_counter() - started
+            if apply(batch) != apply(compacted):
+                wrong += 1
+        failed = failed or wrong > 0
+        print(f"{'+'.join(formats):>12} {args.batches:>8} "
+              f"{compactor.ratio():>6} {seconds:>8.3f} {wrong:>6}")
+    if failed:
+        raise SystemExit("compacted batches left different rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import pathlib
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "abasyn"))
+from diff import diff_operations  # noqa: E402
+
+# Compares the diff engine used by check_tovar_history with the quadratic
+# Levenshtein implementation it replaced, on synthetic m_tovar histories.
+# Where the legacy implementation runs, both must find the same distance.
+
+
+def legacy_levenshtein_distance_operations(list1, list2):
+    len_list1 = len(list1) + 1
+    len_list2 = len(list2) + 1
+    # Create a matrix to store distances and operations
+    matrix = [[0 for n in range(len_list2)] for m in range(len_list1)]
+    operations = [[[] for n in range(len_list2)] for m in range(len_list1)]
+    # Initialize the first row and column of the matrix
+    for i in range(len_list1):
+        matrix[i][0] = i
+        if i > 0:
+            operations[i][0] = operations[i - 1][0] + [
+                ("delete", list1[i - 1], i - 1)
+            ]
+    for j in range(len_list2):
+        matrix[0][j] = j
+        if j > 0:
+            operations[0][j] = operations[0][j - 1] + [
+                ("insert", list2[j - 1], j - 1)
+            ]
+    # Compute the Levenshtein distance and operations
+    for i in range(1, len_list1):
+        for j in range(1, len_list2):
+            if list1[i - 1] == list2[j - 1]:
+                cost = 0
+                operation = []
+            else:
+                cost = 1
+                operation = [
+                    ("substitute", list1[i - 1], list2[j - 1], i - 1, j - 1)
+                ]
+
+            deletion_cost = matrix[i - 1][j] + 1
+            insertion_cost = matrix[i][j - 1] + 1
+            substitution_cost = matrix[i - 1][j - 1] + cost
+
+            min_cost = min(deletion_cost, insertion_cost, substitution_cost)
+            matrix[i][j] = min_cost
+
+            if min_cost == deletion_cost:
+                operations[i][j] = operations[i - 1][j] + [
+                    ("delete", list1[i - 1], i - 1)
+                ]
+            elif min_cost == insertion_cost:
+                operations[i][j] = operations[i][j - 1] + [
+                    ("insert", list2[j - 1], j - 1)
+                ]
+            else:
+                operations[i][j] = operations[i - 1][j - 1] + operation
+
+    return matrix[-1][-1], operations[-1][-1]
+
+
+def make_history(length, seed):
+    rnd = random.Random(seed)
+    history = []
+    for n in range(length):
+        history.append((
+            1234,
+            "A-1234",
+            f"2024-{1 + n // 28 % 12:02d}-{1 + n % 28:02d}",
+            rnd.randint(-50, 50),
+            rnd.randint(1, 10 ** 6),
+            rnd.randint(1, 10 ** 6),
+            rnd.choice((1, 2, 3, 7, 11)),
+            rnd.randint(1, 5),
+            rnd.randint(1, 5),
+        ))
+    return history
+
+
+def mutate(history, changes, seed):
+    rnd = random.Random(seed)
+    result = list(history)
+    for n in range(changes):
+        pos = rnd.randrange(len(result) + 1)
+        kind = rnd.random()
+        if kind < 0.4 and pos < len(result):
+            result.pop(pos)
+        elif kind < 0.7 and pos < len(result):
+            row = list(result[pos])
+            row[3] += 1
+            result[pos] = tuple(row)
+        else:
+            result.insert(pos, make_history(1, seed + n)[0])
+    return result
+
+
+def measure(func, list1, list2):
+    started = time.perf_counter()
+    distance, operations = func(list1, list2)
+    elapsed = time.perf_counter() - started
+    # tracemalloc slows everything down, so memory is measured separately
+    tracemalloc.start()
+    func(list1, list2)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return distance, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the check_tovar_history diff engine"
+    )
+    parser.add_argument(
+        "--sizes", default="100,300,1000,5000,20000,100000",
+        help="comma separated history lengths",
+    )
+    parser.add_argument(
+        "--changes", type=float, default=0.01,
+        help="share of rows changed on the remote side",
+    )
+    parser.add_argument(
+        "--legacy-limit", type=int, default=500,
+        help="largest history the legacy implementation is run on",
+    )
+    args = parser.parse_args()
+    print(f"{'rows':>8} {'impl':>8} {'distance':>9} {'seconds':>9} "
+          f"{'peak MB':>9}")
+    for size in map(int, args.sizes.split(",")):
+        local = make_history(size, size)
+        remote = mutate(local, max(1, int(size * args.changes)), size + 1)
+        impls = [("diff", diff_operations)]
+        if size <= args.legacy_limit:
+            impls.append(("legacy", legacy_levenshtein_distance_operations))
+        distances = set()
+        for name, func in impls:
+            distance, elapsed, peak = measure(func, local, remote)
+            distances.add(distance)
+            print(f"{size:>8} {name:>8} {distance:>9} {elapsed:>9.3f} "
+                  f"{peak / 2 ** 20:>9.1f}")
+        if len(distances) > 1:
+            raise SystemExit(f"distances differ for {size} rows")
+    check_timeout()
+
+
+def check_timeout(size=20000, changes=2000, slack=1.05):
+    # histories too far apart for the exact search within the timeout
+    # must still come out close to their distance, not as one block
+    local = make_history(size, 1)
+    remote = mutate(local, changes, 2)
+    exact = diff_operations(local, remote, timeout=None)[0]
+    started = time.perf_counter()
+    distance = diff_operations(local, remote)[0]
+    elapsed = time.perf_counter() - started
+    print(f"{size:>8} rows, {changes} changes: distance {distance}, "
+          f"exact {exact}, {elapsed:.3f} seconds")
+    if distance > exact * slack:
+        raise SystemExit(f"distance {distance} too far from {exact}")
+
+
+if __name__ == "__main__":
+    main()
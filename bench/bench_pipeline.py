@@ -0,0 +1,193 @@
+import argparse
+import json
+import logging
+import pathlib
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "abasyn"))
+from sysutils import config, logger  # noqa: E402
+
+# End-to-end benchmark of the replication pipeline on the in-process
+# sqlite backend: a synthetic rpl_log backlog is pushed to a number of
+# receivers by the real ProcessingThread workers, no Firebird required.
+
+MASTER_SCHEMA = """
+create table rpl_log (id integer primary key, rpl_sql text);
+create table rpl_databases (
+    id integer primary key, alias text, dbname text, dbuser text,
+    dbpass text, last_id integer default 0
+);
+create table rpl_tables (
+    table_name text, rpl_allfields integer, is_docheader integer
+);
+"""
+RECEIVER_SCHEMA = """
+create table r_tovar (id integer primary key, name text, price numeric);
+"""
+
+
+def changes(rows, records=False):
+    for change_id in range(1, rows + 1):
+        key = (change_id + 1) // 2
+        if records:
+            # the same changes as structured change records
+            if change_id % 2:
+                change = {
+                    "table": "r_tovar", "op": "insert", "key": {"id": key},
+                    "values": {"name": f"item {key}", "price": key % 100},
+                }
+            else:
+                change = {
+                    "table": "r_tovar", "op": "update", "key": {"id": key},
+                    "values": {"price": change_id % 997},
+                }
+            yield change_id, json.dumps(change)
+        elif change_id % 2:
+            sql = (f"insert into r_tovar (id, name, price) "
+                   f"values ({key}, 'item {key}', {key % 100})")
+            yield change_id, sql
+        else:
+            sql = f"update r_tovar set price = {change_id % 997} " \
+                  f"where id = {key}"
+            yield change_id, sql
+
+
+def build(workdir, rows, receivers, records=False):
+    master = str(workdir / "master.db")
+    con = sqlite3.connect(master)
+    con.executescript(MASTER_SCHEMA)
+    con.executemany(
+        "insert into rpl_log values (?, ?)", changes(rows, records)
+    )
+    for n in range(receivers):
+        dsn = str(workdir / f"receiver{n}.db")
+        remote = sqlite3.connect(dsn)
+        remote.executescript(RECEIVER_SCHEMA)
+        remote.close()
+        con.execute(
+            "insert into rpl_databases (alias, dbname, dbuser, dbpass) "
+            "values (?, ?, '', '')", [f"receiver{n}", dsn],
+        )
+    con.commit()
+    con.close()
+    return master
+
+
+def run(args):
+    logger.setLevel(logging.WARNING)
+    config["backend"] = {"name": "sqlite", "latency": args.latency / 1000}
+    config["replication"] = {
+        "batch_size": args.batch_size,
+        "group_size": args.group_size,
+        "commit_rows": args.commit_rows,
+        "commit_interval": args.commit_interval,
+        "adaptive": not args.fixed_batch,
+    }
+    config["janitor"] = {"chunk_size": args.chunk_size, "pause": 0}
+    import db
+
+    with tempfile.TemporaryDirectory() as tmp:
+        started = time.perf_counter()
+        master = build(
+            pathlib.Path(tmp), args.rows, args.receivers, args.records
+        )
+        setup = time.perf_counter() - started
+        config["database"] = {"dsn": master, "user": "", "password": ""}
+        local = db.connect_to_database(**config["database"])
+        cur = local.cursor()
+        cur.execute(
+            "select id, alias, dbname, dbuser, dbpass, last_id "
+            "from rpl_databases"
+        )
+        workers = [db.ProcessingThread(row) for row in cur.fetchall()]
+        local.rollback()
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+            worker.queue.put()
+        while any(worker.last_id < args.rows for worker in workers):
+            time.sleep(0.01)
+        replicated = time.perf_counter() - started
+        for worker in workers:
+            worker.stop()
+            worker.join()
+        started = time.perf_counter()
+        db.JanitorThread(lambda: []).purge(local)
+        cleanup = time.perf_counter() - started
+        local.close()
+        pull = sum(db.PULL_LATENCY.summary(w.alias)[0] for w in workers)
+        apply = sum(db.APPLY_LATENCY.summary(w.alias)[0] for w in workers)
+        commit = sum(db.COMMIT_LATENCY.summary(w.alias)[0] for w in workers)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    total = args.rows * args.receivers
+    print(
+        f"{args.rows:>10} {args.receivers:>4} {total / replicated:>11.0f} "
+        f"{replicated:>9.2f} {pull:>8.2f} {apply:>8.2f} {commit:>8.2f} "
+        f"{cleanup:>8.2f} {setup:>8.2f} {rss:>8.1f}",
+        flush=True,
+    )
+
+
+def header():
+    print(
+        f"{'rows':>10} {'rcv':>4} {'rows/sec':>11} {'seconds':>9} "
+        f"{'pull':>8} {'apply':>8} {'commit':>8} {'cleanup':>8} "
+        f"{'setup':>8} {'RSS MB':>8}",
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the replication pipeline without Firebird"
+    )
+    parser.add_argument(
+        "--sizes", default="10000,100000,1000000",
+        help="comma separated rpl_log backlog sizes, each run in a "
+             "separate process",
+    )
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--receivers", type=int, default=2)
+    parser.add_argument(
+        "--latency", type=float, default=0,
+        help="simulated round trip per statement and commit, ms",
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--group-size", type=int, default=50)
+    parser.add_argument("--commit-rows", type=int, default=1000)
+    parser.add_argument("--commit-interval", type=int, default=500)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument(
+        "--fixed-batch", action="store_true",
+        help="keep batch size and commit interval instead of adapting them",
+    )
+    parser.add_argument(
+        "--records", action="store_true",
+        help="log structured change records instead of literal SQL",
+    )
+    args = parser.parse_args()
+    if args.rows is not None:
+        run(args)
+        return
+    header()
+    for rows in map(int, args.sizes.split(",")):
+        # a fresh process per size keeps the peak RSS figures honest
+        command = [sys.executable, __file__, "--rows", str(rows)]
+        for name in ("receivers", "latency", "batch_size", "group_size",
+                     "commit_rows", "commit_interval", "chunk_size"):
+            option = "--" + name.replace("_", "-")
+            command += [option, str(getattr(args, name))]
+        if args.fixed_batch:
+            command.append("--fixed-batch")
+        if args.records:
+            command.append("--records")
+        subprocess.run(command, check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+from bench_pipeline import build  # noqa: E402
+
+# Measures how long a fresh interpreter takes to import the service
+# modules, load the configuration, build the Flask app and get the listener
+# to its first receiver, as a restart by systemd would. The listener runs
+# on the sqlite backend, so no Firebird is needed.
+
+ABASYN = pathlib.Path(__file__).parent.parent / "abasyn"
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {abasyn!r})
+marks = {{}}
+import db
+marks["import db"] = time.perf_counter() - started
+from sysutils import config, setup_logging
+config.get("database")
+marks["load config"] = time.perf_counter() - started
+setup_logging()
+try:
+    from app import create_app
+    create_app()
+    marks["create app"] = time.perf_counter() - started
+except ImportError:
+    pass
+listener = db.listener_thread()
+while not listener.workers:
+    time.sleep(0.001)
+marks["listener ready"] = time.perf_counter() - started
+db.stop_event_processing()
+listener.join()
+print(json.dumps(marks))
+"""
+
+CONFIG = """
+database: {{dsn: {dsn!r}, user: '', password: ''}}
+log: {{file: {log!r}}}
+backend: {{name: sqlite}}
+replication: {{mode: events}}
+janitor: {{interval: 3600}}
+webservice: {{port: 5000}}
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark service startup and import cost"
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = pathlib.Path(tmp)
+        master = build(workdir, 10, 1)
+        settings = workdir / "abasyn.yml"
+        settings.write_text(
+            CONFIG.format(dsn=master, log=str(workdir / "abasyn.log"))
+        )
+        env = dict(os.environ, ABASYN_CONFIG=str(settings))
+        probe = PROBE.format(abasyn=str(ABASYN))
+        samples = {}
+        for _ in range(args.runs):
+            started = subprocess.run(
+                [sys.executable, "-c", probe], env=env, cwd=tmp,
+                check=True, capture_output=True, text=True,
+            )
+            for mark, seconds in json.loads(started.stdout).items():
+                samples.setdefault(mark, []).append(seconds)
+    print(f"{'stage':<16} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for mark, values in samples.items():
+        print(
+            f"{mark:<16} {statistics.median(values) * 1000:>10.1f} "
+            f"{min(values) * 1000:>8.1f} {max(values) * 1000:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()